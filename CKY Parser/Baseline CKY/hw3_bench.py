@@ -0,0 +1,197 @@
+"""
+Kim Dodds - LING 571 - Winter 2020
+HW 3 Benchmark File
+
+Benchmarks the baseline CKY parser across sentence length
+and ambiguity. Synthetic sentences of each requested length
+are sampled from the grammar itself and binned by their
+number of parses, and the test sentences are run as well.
+Wall time, peak memory and chart entries are written per
+sentence to a JSON file together with per-length averages,
+which can be compared against a stored earlier run.
+"""
+
+#PREPROCESSOR DIRECTIVES
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from hw3_parser import CKYParser, write_parses
+
+class SentenceSampler:
+    """
+    Samples sentences of an exact length from a CFG. inside[X][L] is the
+    number of derivations of exactly L words from X, so choosing each rule
+    and split point in proportion to it samples uniformly among the
+    derivations of that length.
+    """
+    def __init__(self, grammar, max_length):
+        self.grammar = grammar
+        size = len(grammar.nonterminals)
+        self.words = [[] for i in range(size)]
+        for term, parents in grammar.lexical.items():
+            for p in parents:
+                self.words[p].append(term.strip("'"))
+        self.rules = [[] for i in range(size)]
+        for a, rights in grammar.binary.items():
+            for b, parents in rights.items():
+                for p in parents:
+                    self.rules[p].append((a, b))
+
+        self.inside = [[0] * (max_length + 1) for i in range(size)]
+        for p in range(size):
+            self.inside[p][1] = len(self.words[p])
+        for length in range(2, max_length + 1):
+            for p in range(size):
+                total = 0
+                for a, b in self.rules[p]:
+                    for k in range(1, length):
+                        total += self.inside[a][k] * self.inside[b][length - k]
+                self.inside[p][length] = total
+
+    def sample(self, length, rng):
+        top = self.grammar.ids.get('TOP')
+        if top is None or self.inside[top][length] == 0:
+            return None
+        words = []
+        self.expand(top, length, rng, words)
+        return words
+
+    def expand(self, label, length, rng, words):
+        if length == 1:
+            words.append(rng.choice(self.words[label]))
+            return
+        options = []
+        weights = []
+        for a, b in self.rules[label]:
+            for k in range(1, length):
+                weight = self.inside[a][k] * self.inside[b][length - k]
+                if weight > 0:
+                    options.append((a, b, k))
+                    weights.append(weight)
+        a, b, k = rng.choices(options, weights)[0]
+        self.expand(a, k, rng, words)
+        self.expand(b, length - k, rng, words)
+
+#parse one sentence twice, writing its parses to sink: once timed, once under tracemalloc for peak memory
+def measure(CKY, line, max_parses, sink):
+    start = time.perf_counter()
+    write_parses(CKY, line, sink, max_parses)
+    seconds = time.perf_counter() - start
+    table = CKY.parse(CKY.initialize_table(line.split(' ')))
+    entries = sum(len(cell.counts) for row in table for cell in row if cell is not None)
+    parses = CKY.count_parses(table)
+
+    tracemalloc.start()
+    write_parses(CKY, line, sink, max_parses)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, entries, parses
+
+#parse the first sentence of each length untimed, so the lazily built grammar
+#tables (span bounds, per-length filters) are not charged to it
+def warm_up(CKY, sentences):
+    seen = set()
+    for source, line in sentences:
+        words = line.split(' ')
+        if len(words) not in seen:
+            seen.add(len(words))
+            CKY.parse(CKY.initialize_table(words))
+
+#average time, memory and entries per (source, length)
+def summarize(results):
+    groups = {}
+    for r in results:
+        groups.setdefault((r['source'], r['length']), []).append(r)
+    summary = {}
+    for (source, length), rows in sorted(groups.items()):
+        summary.setdefault(source, {})[str(length)] = {
+            'sentences': len(rows),
+            'seconds': sum(r['seconds'] for r in rows) / len(rows),
+            'peak_bytes': sum(r['peak_bytes'] for r in rows) / len(rows),
+            'entries': sum(r['entries'] for r in rows) / len(rows)}
+    return summary
+
+#print the per-length mean time of this run against a stored run
+def compare(summary, baseline, out):
+    out.write("source\tlength\tbase_sec\tsec\tratio\tbase_entries\tentries\n")
+    for source, lengths in summary.items():
+        for length, row in lengths.items():
+            base = baseline.get(source, {}).get(length)
+            if base is None:
+                continue
+            ratio = row['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+            out.write("{}\t{}\t{:.6f}\t{:.6f}\t{:.2f}\t{:.1f}\t{:.1f}\n".format(
+                source, length, base['seconds'], row['seconds'], ratio, base['entries'], row['entries']))
+
+#MAIN FUNCTION
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('grammar')
+    parser.add_argument('test')
+    parser.add_argument('output')
+    parser.add_argument('--max-parses', type=int, default=10,
+                        help='enumerate at most this many parses per sentence, as in hw3_parser.py; 0 for all')
+    parser.add_argument('--lengths', default='5,10,15,20,25,30',
+                        help='comma-separated synthetic sentence lengths')
+    parser.add_argument('--ambiguity', default='1,10,100',
+                        help='comma-separated lower bounds of the parse-count bins')
+    parser.add_argument('--per-bin', type=int, default=3,
+                        help='synthetic sentences per length and ambiguity bin')
+    parser.add_argument('--tries', type=int, default=200,
+                        help='samples drawn per length while filling the bins')
+    parser.add_argument('--seed', type=int, default=571)
+    parser.add_argument('--baseline', default=None,
+                        help='earlier benchmark JSON to compare the per-length averages against')
+    args = parser.parse_args()
+
+    CKY = CKYParser()
+    CKY.load_grammar(args.grammar)
+
+    lengths = [int(l) for l in args.lengths.split(',')]
+    bounds = [int(b) for b in args.ambiguity.split(',')]
+    sampler = SentenceSampler(CKY.grammar, max(lengths))
+    rng = random.Random(args.seed)
+
+    sentences = []
+    for length in lengths:
+        bins = {b: [] for b in bounds}
+        for t in range(args.tries):
+            if all(len(found) >= args.per_bin for found in bins.values()):
+                break
+            words = sampler.sample(length, rng)
+            if words is None:
+                break
+            line = ' '.join(words)
+            parses = CKY.count_parses(CKY.parse(CKY.initialize_table(words)))
+            bound = max([b for b in bounds if b <= parses], default=None)
+            if bound is not None and len(bins[bound]) < args.per_bin:
+                bins[bound].append(line)
+        for bound in bounds:
+            for line in bins[bound]:
+                sentences.append(('synthetic', line))
+    for line in open(args.test).read().strip().split('\n'):
+        sentences.append(('test', line))
+
+    warm_up(CKY, sentences)
+    results = []
+    sink = open(os.devnull, 'w')
+    for source, line in sentences:
+        seconds, peak, entries, parses = measure(CKY, line, args.max_parses or None, sink)
+        results.append({'source': source, 'length': len(list(filter(None, line.split(' ')))),
+                        'parses': parses, 'seconds': seconds, 'peak_bytes': peak,
+                        'entries': entries, 'sentence': line})
+
+    report = {'grammar': args.grammar, 'results': results, 'summary': summarize(results)}
+    with open(args.output, 'w') as out:
+        json.dump(report, out, indent=1)
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))['summary']
+        compare(report['summary'], baseline, sys.stdout)
+
+if __name__ == '__main__':
+    main()
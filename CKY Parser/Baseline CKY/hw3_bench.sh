@@ -0,0 +1,2 @@
+#!/bin/sh
+python3 hw3_bench.py $@
@@ -10,111 +10,752 @@ a CYK parser for a fragment of the ATIS corpus.
 import sys
 import os
 import re
+import math
+import mmap
+import hashlib
+import tempfile
+import shutil
+import argparse
+import itertools
+import multiprocessing
+import signal
+import json
+import time
 import numpy as np
 
+#header of a compiled grammar cache file, followed by the sha256 of the source grammar
+CACHE_MAGIC = b'CKYGRAM1'
+
+#most derivations of one set of labels in a cell that parse enumeration keeps as a list
+SMALL_FOREST = 256
+
+#most characters of one sentence's output held in memory before it is spilled to a temporary file
+BLOCK_BUFFER = 1 << 20
+
+#(min, max) yield length of every label and (min, max) words before and after it
+#in a derivation from top, given binary (parent, left, right) rules and lexical parents
+def yield_bounds(labels, top, rules, lexical):
+    inf = math.inf
+    size = len(labels)
+    low = [inf] * size
+    for p in lexical:
+        low[p] = 1
+    changed = True
+    while changed:
+        changed = False
+        for p, a, b in rules:
+            if low[a] + low[b] < low[p]:
+                low[p] = low[a] + low[b]
+                changed = True
+    #rules whose children can never derive words cannot be used
+    rules = [(p, a, b) for p, a, b in rules if low[a] < inf and low[b] < inf]
+    children = [set() for i in range(size)]
+    for p, a, b in rules:
+        children[p].update((a, b))
+    below = []
+    for label in range(size):
+        seen = set()
+        stack = list(children[label])
+        while stack:
+            x = stack.pop()
+            if x not in seen:
+                seen.add(x)
+                stack.extend(children[x])
+        below.append(seen)
+
+    #every binary rule adds words, so a label that can derive itself has no maximum
+    high = [1 if low[x] == 1 else 0 for x in range(size)]
+    for x in range(size):
+        if x in below[x] or any(y in below[y] for y in below[x]):
+            high[x] = inf
+    changed = True
+    while changed:
+        changed = False
+        for p, a, b in rules:
+            if high[a] + high[b] > high[p]:
+                high[p] = high[a] + high[b]
+                changed = True
+    yields = [(low[x], high[x] if low[x] < inf else 0) for x in range(size)]
+
+    sides = []
+    for side in (0, 1):
+        #a child gains its sibling's words on one side and keeps its parent's context
+        edges = []
+        for p, a, b in rules:
+            edges.append((p, a, low[b] if side else 0, high[b] if side else 0))
+            edges.append((p, b, 0 if side else low[a], 0 if side else high[a]))
+        least = [inf] * size
+        most = [-1] * size
+        if top is not None:
+            least[top] = most[top] = 0
+        changed = True
+        while changed:
+            changed = False
+            for p, x, lo, hi in edges:
+                if least[p] + lo < least[x]:
+                    least[x] = least[p] + lo
+                    changed = True
+        #context grows without limit through an unbounded sibling or a cycle that adds words
+        unbounded = set()
+        for p, x, lo, hi in edges:
+            if least[p] < inf and (hi == inf or (hi > 0 and (p == x or p in below[x]))):
+                unbounded.add(x)
+                unbounded.update(below[x])
+        for x in unbounded:
+            most[x] = inf
+        changed = True
+        while changed:
+            changed = False
+            for p, x, lo, hi in edges:
+                if least[p] < inf and most[x] < inf and most[p] + hi > most[x]:
+                    most[x] = most[p] + hi
+                    changed = True
+        sides.append([(least[x], most[x]) for x in range(size)])
+    return yields, sides[0], sides[1]
+
 class CKYIndex:
-    index = None
-    terminal = None
-    nonterminal = None
+    __slots__ = ('index', 'terminal', 'backpointers', 'counts')
 
     def __init__(self):
         self.index = []
         self.terminal = ''
-        self.nonterminal = []
+        #packed forest: one entry per nonterminal id, holding its
+        #(split, left, right) backpointers and its number of derivations
+        self.backpointers = {}
+        self.counts = {}
+
+class CKYGrammar:
+    """
+    Integer-compiled form of a CNF grammar. Nonterminals are mapped to
+    dense ids; binary rules are indexed left child -> right child -> parents
+    and lexical rules terminal -> parents, so the parser never builds or
+    hashes rule strings.
+    """
+    __slots__ = ('nonterminals', 'ids', 'binary', 'lexical', 'bounds', 'exclusions')
+
+    def __init__(self):
+        self.nonterminals = []
+        self.ids = {}
+        self.binary = {}
+        self.lexical = {}
+        self.bounds = None
+        self.exclusions = {}
+
+    def intern(self, label):
+        if label not in self.ids:
+            self.ids[label] = len(self.nonterminals)
+            self.nonterminals.append(label)
+        return self.ids[label]
+
+    def add_rule(self, left, right):
+        parent = self.intern(left)
+        right = right.split(' ')
+        if len(right) == 1:
+            parents = self.lexical.setdefault(right[0], [])
+        else:
+            rights = self.binary.setdefault(self.intern(right[0]), {})
+            parents = rights.setdefault(self.intern(right[1]), [])
+        if parent not in parents:
+            parents.append(parent)
+            self.bounds = None
+            self.exclusions = {}
+
+    def span_bounds(self):
+        """
+        Bounds on where each nonterminal can sit in a complete parse.
+        yields[X] is the (min, max) number of words X derives; left[X] and
+        right[X] are the (min, max) number of words a derivation from TOP
+        can put before and after X. Unbounded maxima are inf, and labels
+        TOP cannot reach have a minimum of inf.
+        """
+        if self.bounds is None:
+            self.bounds = yield_bounds(self.nonterminals, self.ids.get('TOP'),
+                                       [(p, a, b) for a, rights in self.binary.items()
+                                        for b, parents in rights.items() for p in parents],
+                                       [p for parents in self.lexical.values() for p in parents])
+        return self.bounds
+
+    def span_exclusions(self, n, after=True):
+        """
+        Labels that cannot fill a cell in a complete parse, as a table
+        indexed by the number of words before the cell and the number
+        after it, grown to cover sentences of n words. When after is
+        false only the words before the cell are checked.
+        """
+        yields, left, right = self.span_bounds()
+        table = self.exclusions.setdefault(after, [])
+        while len(table) < n:
+            table.append([])
+        for words, row in enumerate(table[:n]):
+            while len(row) < n - words:
+                rest = len(row) if after else None
+                row.append(frozenset(x for x in range(len(self.nonterminals))
+                                     if not left[x][0] <= words <= left[x][1]
+                                     or rest is not None and not right[x][0] <= rest <= right[x][1]))
+        return table
+
+    def save(self, path, digest):
+        """
+        Write the compiled grammar as a flat binary file: magic, source
+        digest and counts, then the rule columns as raw int32 arrays and
+        the nonterminal and terminal strings as newline-joined UTF-8
+        blocks. Rules keep their insertion order so a loaded grammar
+        iterates exactly like one built from text.
+        """
+        binary = [(a, b, p) for a, rights in self.binary.items()
+                  for b, parents in rights.items() for p in parents]
+        terms = list(self.lexical)
+        lexical = [(t, p) for t, term in enumerate(terms) for p in self.lexical[term]]
+        names = "\n".join(self.nonterminals).encode('utf-8')
+        vocab = "\n".join(terms).encode('utf-8')
+        header = [len(self.nonterminals), len(terms), len(binary), len(lexical), len(names), len(vocab)]
+        #a uniquely named temporary file, so runs saving at the same time never write into one file
+        handle, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(digest)
+            f.write(np.array(header, dtype=np.int64).tobytes())
+            for rules, i in [(binary, 0), (binary, 1), (binary, 2), (lexical, 0), (lexical, 1)]:
+                f.write(np.array([r[i] for r in rules], dtype=np.int32).tobytes())
+            f.write(names)
+            f.write(vocab)
+        #mkstemp creates the file readable by its owner only
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+
+    def load(self, path, digest):
+        """
+        Memory-map a cache file written by save. Returns False, leaving
+        the grammar untouched, if the file is missing, unreadable, shorter
+        or longer than its header says, or was compiled from a different
+        source grammar.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            if data[:len(CACHE_MAGIC)] != CACHE_MAGIC or data[len(CACHE_MAGIC):len(CACHE_MAGIC)+32] != digest:
+                return False
+            offset = len(CACHE_MAGIC) + 32
+            size, nterms, nbinary, nlexical, nnames, nvocab = np.frombuffer(data, np.int64, 6, offset).tolist()
+            offset += 6 * 8
+            columns = []
+            for count in [nbinary, nbinary, nbinary, nlexical, nlexical]:
+                columns.append(np.frombuffer(data, np.int32, count, offset).tolist())
+                offset += count * 4
+            #a truncated or half-written file is rebuilt
+            if offset + nnames + nvocab != len(data):
+                return False
+            names = data[offset:offset+nnames].decode('utf-8')
+            vocab = data[offset+nnames:offset+nnames+nvocab].decode('utf-8')
+        except ValueError:
+            return False
+        finally:
+            data.close()
+
+        left, right, parent, term, lexical_parent = columns
+        self.__init__()
+        self.nonterminals = names.split("\n") if size else []
+        self.ids = {label: i for i, label in enumerate(self.nonterminals)}
+        terms = vocab.split("\n") if nterms else []
+        for a, b, p in zip(left, right, parent):
+            self.binary.setdefault(a, {}).setdefault(b, []).append(p)
+        for t, p in zip(term, lexical_parent):
+            self.lexical.setdefault(terms[t], []).append(p)
+        return True
 
 class CKYParser:
-    left_right = None
-    right_left = None
+    grammar = None
 
     def __init__(self):
-        self.left_right = {}
-        self.right_left = {}
+        self.grammar = CKYGrammar()
+        #when instrument is set, counters for the most recent sentence
+        self.instrument = False
+        self.stats = None
+        #reuse the leading chart columns of the previous sentence when it
+        #starts with the same tokens
+        self.share_prefixes = False
+        self.prefix = None
+        #never add chart entries whose label cannot have the words before
+        #and after their span in any complete parse; parses are unchanged
+        self.span_filter = True
 
     def initialize_grammar(self, raw_grammar):
         grammar = raw_grammar.strip(" ").split('\n')
         for g in grammar:
             g = g.split(' -> ')
             if len(g) > 1:
-                left = g[0]
-                right = g[1]
-                if left not in self.left_right:
-                   self.left_right[left] = []
-                if right not in self.left_right[left]:
-                    self.left_right[left].append(right)
-                if right not in self.right_left:
-                    self.right_left[right] = []
-                if left not in self.right_left[right]:
-                    self.right_left[right].append(left)
+                self.grammar.add_rule(g[0], g[1])
 
         return
 
+    def load_grammar(self, path, cache=True):
+        """
+        Load a grammar file, using the compiled cache at path + '.cache'
+        when it was built from the same file contents and rebuilding it
+        otherwise.
+        """
+        raw = open(path, 'rb').read()
+        digest = hashlib.sha256(raw).digest()
+        if cache and self.grammar.load(path + '.cache', digest):
+            return
+        self.initialize_grammar(raw.decode('utf-8').strip())
+        if cache:
+            try:
+                self.grammar.save(path + '.cache', digest)
+            except OSError:
+                pass
+
     def initialize_table(self, tokens):
         tokens = list(filter(None, tokens))
-        table = np.empty( (len(tokens), len(tokens)), dtype=object )
+        if self.instrument:
+            self.stats = {'tokens': len(tokens), 'seconds': 0.0, 'cells': 0, 'entries': 0,
+                          'max_cell': 0, 'max_cell_span': None,
+                          'lexical_seconds': 0.0, 'binary_seconds': 0.0}
+        table = [[None] * len(tokens) for t in tokens]
         i = 0
         while i < len(tokens):
-            table[i,i] = CKYIndex()
-            table[i,i].terminal = "'" + tokens[i].strip(".!?,") + "'"
-            table[i,i].index = [i,i+1]
+            table[i][i] = CKYIndex()
+            table[i][i].terminal = "'" + tokens[i].strip(".!?,") + "'"
+            table[i][i].index = [i,i+1]
             i += 1
         return table
 
     def parse(self, table):
-        row = 0
-        col = 0
-        while col < len(table[0,:]):
-            while row >= 0:
+        binary = self.grammar.binary
+        n = len(table)
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        filters = self.span_filters(n)
+        for col in range(self.reuse_prefix(table), n):
+            for row in range(col, -1, -1):
+                if stats is not None:
+                    clock = time.perf_counter()
+                #labels that cannot fill this cell in a complete parse are never added
+                excluded = filters[row][n - 1 - col] if filters is not None else ()
                 if row == col:
-                    term = table[row,col].terminal
-                    for nt in self.right_left[term]:
-                        table[row,col].nonterminal.append((nt,"("+term+"/"+nt+")"))
-                else:
-                    table[row,col] = CKYIndex()
-                    table[row,col].index = [row,col+1]
-                    ctemp = col- 1
-                    rtemp = col
-                    while rtemp != row:
-                        index1 = table[row, ctemp]
-                        index2 = table[rtemp, col]
-                        for i in index1.nonterminal:
-                            for j in index2.nonterminal:
-                                production = i[0] + " " + j[0]
-                                if production in self.right_left:
-                                    for lhs in self.right_left[production]:
-                                        table[row,col].nonterminal.append((lhs,"("+lhs+" "+i[1]+" "+j[1]+")"))
-                        ctemp -= 1
-                        rtemp -= 1
-
-                row -= 1
-            col += 1
-            row = col
-
-        parses = []
-        for top in table[0,col-1].nonterminal:
-            if top[0] == 'TOP': parses.append(top[1])
-        return parses
+                    cell = table[row][col]
+                    for nt in self.grammar.lexical.get(cell.terminal, ()):
+                        if nt in excluded:
+                            continue
+                        cell.backpointers[nt] = []
+                        cell.counts[nt] = 1
+                    if stats is not None:
+                        self.record_cell(len(cell.counts), row, col, clock, 'lexical_seconds')
+                    continue
+
+                cell = table[row][col] = CKYIndex()
+                cell.index = [row,col+1]
+                backpointers = cell.backpointers
+                counts = cell.counts
+                for split in range(col - 1, row - 1, -1):
+                    left = table[row][split]
+                    right = table[split + 1][col]
+                    for a, count_a in left.counts.items():
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        for b, count_b in right.counts.items():
+                            parents = rights.get(b)
+                            if parents is None:
+                                continue
+                            for lhs in parents:
+                                if lhs in counts:
+                                    backpointers[lhs].append((split, a, b))
+                                    counts[lhs] += count_a * count_b
+                                elif lhs not in excluded:
+                                    backpointers[lhs] = [(split, a, b)]
+                                    counts[lhs] = count_a * count_b
+                if stats is not None:
+                    self.record_cell(len(counts), row, col, clock, 'binary_seconds')
+            if self.prefix is not None:
+                self.prefix[2] = col + 1
+
+        if stats is not None:
+            stats['seconds'] = time.perf_counter() - start
+            self.count_combinations(table)
+        return table
+
+    def reuse_prefix(self, table):
+        """
+        Copy into table the columns of the previous sentence's chart whose
+        cells span only tokens the two sentences share at the start, since
+        a column's cells depend on nothing to their right, and return the
+        first column left to fill.
+        """
+        if not self.share_prefixes:
+            return 0
+        n = len(table)
+        terminals = [table[i][i].terminal for i in range(n)]
+        start = 0
+        if self.prefix is not None:
+            previous, old, filled = self.prefix
+            limit = min(filled, n)
+            while start < limit and previous[start] == terminals[start]:
+                start += 1
+            for col in range(start):
+                for row in range(col + 1):
+                    table[row][col] = old[row][col]
+        #terminals, chart and number of finished columns
+        self.prefix = [terminals, table, start]
+        if self.stats is not None:
+            self.stats['reused_columns'] = start
+        return start
+
+    def span_filters(self, n):
+        """
+        Table of the labels to drop from the cell of an n-word sentence at
+        [row][n - 1 - col], or None when span filtering is off. Columns
+        shared across sentences by reuse_prefix must not depend on the
+        sentence length, so then only the words before a cell are checked.
+        """
+        if not self.span_filter or 'TOP' not in self.grammar.ids:
+            return None
+        return self.grammar.span_exclusions(n, not self.share_prefixes)
+
+    def record_cell(self, size, row, col, clock, phase):
+        stats = self.stats
+        stats[phase] += time.perf_counter() - clock
+        stats['cells'] += 1
+        stats['entries'] += size
+        if size > stats['max_cell']:
+            stats['max_cell'] = size
+            stats['max_cell_span'] = [row, col+1]
+
+    def count_combinations(self, table):
+        """
+        Recount from the finished chart the entry pairs the binary fill
+        combined, the rule lookups it made (left-child probes plus
+        (left, right) pair probes) and how many found rules, so the fill
+        loop itself carries no counters.
+        """
+        binary = self.grammar.binary
+        pairs = lookups = hits = 0
+        for col in range(len(table)):
+            for row in range(col):
+                for split in range(row, col):
+                    left = table[row][split].counts
+                    right = table[split + 1][col].counts
+                    pairs += len(left) * len(right)
+                    lookups += len(left)
+                    for a in left:
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        lookups += len(right)
+                        hits += 1
+                        for b in right:
+                            if b in rights:
+                                hits += 1
+        self.stats.update(pairs=pairs, lookups=lookups, hits=hits)
+
+    def count_parses(self, table):
+        top = self.grammar.ids.get('TOP')
+        if len(table) == 0:
+            return 0
+        return table[0][len(table)-1].counts.get(top, 0)
+
+    def enumerate_parses(self, table, limit=None):
+        """
+        Lazily yield the bracketed TOP parses stored in the forest,
+        stopping after limit parses when a limit is given.
+        """
+        if self.count_parses(table) == 0:
+            return iter(())
+        top = self.grammar.ids['TOP']
+        trees = (tree for label, tree in self.derivations(table, 0, len(table)-1, frozenset([top]), {}, {}))
+        return itertools.islice(trees, limit)
+
+    def derivations(self, table, row, col, labels, groups, trees):
+        """
+        The (label, tree) pairs of the derivations in a cell whose label
+        is in labels, in the order the original unpacked chart listed them.
+        Sets of at most SMALL_FOREST derivations are built once and kept in
+        trees; larger ones are generated lazily each time.
+        """
+        key = (row, col, labels)
+        found = trees.get(key)
+        if found is not None:
+            return found
+        cell = table[row][col]
+        found = self.unpack(table, row, col, labels, groups, trees)
+        if sum(cell.counts[x] for x in labels) <= SMALL_FOREST:
+            found = trees[key] = list(found)
+        return found
+
+    def unpack(self, table, row, col, labels, groups, trees):
+        """
+        Generate the derivations for derivations(): split points from right
+        to left, then every left derivation with every right derivation,
+        then the parents in grammar order. groups caches the backpointers
+        of a cell regrouped for a set of labels.
+        """
+        cell = table[row][col]
+        names = self.grammar.nonterminals
+        if row == col:
+            for nt in cell.counts:
+                if nt in labels:
+                    yield nt, "("+cell.terminal+"/"+names[nt]+")"
+            return
+        key = (row, col, labels)
+        if key not in groups:
+            #for each split, the right labels each left label combines with into one of labels
+            splits = {}
+            for lhs in labels:
+                for split, a, b in cell.backpointers[lhs]:
+                    splits.setdefault(split, {}).setdefault(a, set()).add(b)
+            binary = self.grammar.binary
+            groups[key] = []
+            for split in sorted(splits, reverse=True):
+                pairs = {}
+                for a, rights in splits[split].items():
+                    #the parents in labels of each (a, b), in grammar order, with their opening bracket
+                    heads = {b: [(lhs, "("+names[lhs]+" ") for lhs in binary[a][b] if lhs in labels]
+                             for b in rights}
+                    pairs[a] = (frozenset(rights), heads)
+                groups[key].append((split, frozenset(pairs), pairs))
+        for split, lefts, pairs in groups[key]:
+            for a, tree_a in self.derivations(table, row, split, lefts, groups, trees):
+                rights, heads = pairs[a]
+                for b, tree_b in self.derivations(table, split + 1, col, rights, groups, trees):
+                    for lhs, head in heads[b]:
+                        yield lhs, head+tree_a+" "+tree_b+")"
+
+#write the output block for one sentence: the sentence, its parses and the parse count,
+#each parse as soon as it is enumerated, flushing it too when flush is set
+def write_parses(CKY, line, output, max_parses=None, flush=False):
+    table = CKY.parse(CKY.initialize_table(line.split(' ')))
+    output.write(line+'\n')
+    for p in CKY.enumerate_parses(table, max_parses):
+        output.write(p+'\n')
+        if flush:
+            output.flush()
+    output.write("Number of parses:"+str(CKY.count_parses(table))+"\n\n")
+
+class BlockBuffer:
+    """
+    One sentence's output held back until it can be written: kept in
+    memory up to BLOCK_BUFFER characters, then spilled to a temporary
+    file. A closed buffer pickles as its text or file name, so workers
+    can hand it to the parent process.
+    """
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.file = None
+        self.path = None
+
+    def write(self, text):
+        if self.file is not None:
+            self.file.write(text)
+            return
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size > BLOCK_BUFFER:
+            handle, self.path = tempfile.mkstemp(suffix='.parses')
+            self.file = os.fdopen(handle, 'w')
+            self.file.write(''.join(self.parts))
+            self.parts = []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self
+
+    def discard(self):
+        self.close()
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+        self.parts = []
+        self.size = 0
+
+    def copy_to(self, output):
+        self.close()
+        if self.path is None:
+            output.write(''.join(self.parts))
+        else:
+            with open(self.path) as spilled:
+                shutil.copyfileobj(spilled, output)
+        self.discard()
+
+class ParseTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise ParseTimeout()
+
+#write one sentence under the per-sentence limits; a sentence longer than
+#max_tokens or taking longer than timeout seconds gets a "Parse skipped" line.
+#With a timeout the parses are held in a BlockBuffer until the sentence is done,
+#so a sentence that runs out of time leaves no partial output
+def parse_limited(CKY, line, output, max_parses=None, timeout=None, max_tokens=None, flush=False):
+    if max_tokens and len(list(filter(None, line.split(' ')))) > max_tokens:
+        output.write(line+"\nParse skipped: too many tokens\n\n")
+        return
+    if not timeout:
+        write_parses(CKY, line, output, max_parses, flush)
+        return
+    buffer = output if isinstance(output, BlockBuffer) else BlockBuffer()
+    try:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        write_parses(CKY, line, buffer, max_parses)
+    except ParseTimeout:
+        buffer.discard()
+        buffer.write(line+"\nParse skipped: time limit\n\n")
+    finally:
+        #disarm the timer on every exit, so it cannot fire later in another sentence or the caller
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if buffer is not output:
+        buffer.copy_to(output)
+
+#write one sentence's counters as a JSON line, with the mean cell size
+def write_stats(stats, index, stats_output):
+    if stats is None:
+        stats = {'tokens': 0, 'skipped': True}
+    stats = dict({'sentence': index}, **stats)
+    if 'cells' in stats:
+        stats['mean_cell'] = stats['entries'] / stats['cells'] if stats['cells'] else 0.0
+    stats_output.write(json.dumps(stats) + "\n")
+
+#parse sentences one at a time, writing and flushing each result as soon as it is ready;
+#with flush_parses each parse is flushed as it is enumerated, unless a timeout holds it back
+def parse_stream(CKY, lines, output, max_parses=None, timeout=None, max_tokens=None, stats_output=None,
+                 flush_parses=False):
+    for index, line in enumerate(lines, 1):
+        CKY.stats = None
+        parse_limited(CKY, line.rstrip('\n'), output, max_parses, timeout, max_tokens, flush_parses)
+        output.flush()
+        if stats_output is not None:
+            write_stats(CKY.stats, index, stats_output)
+            stats_output.flush()
+
+#parse sentences in token order so that sentences sharing leading words are adjacent
+#and can reuse each other's chart columns. The sentence next in input order is written
+#straight to output, later ones are held until every sentence before them is written
+def parse_sorted(CKY, lines, output, max_parses=None, timeout=None, max_tokens=None, stats_output=None):
+    order = sorted(range(len(lines)), key=lambda i: list(filter(None, lines[i].split(' '))))
+    pending = {}
+    next_index = 0
+    for index in order:
+        CKY.stats = None
+        if index == next_index:
+            parse_limited(CKY, lines[index], output, max_parses, timeout, max_tokens)
+            block = None
+        else:
+            block = BlockBuffer()
+            parse_limited(CKY, lines[index], block, max_parses, timeout, max_tokens)
+            block.close()
+        pending[index] = (block, CKY.stats)
+        while next_index in pending:
+            block, stats = pending.pop(next_index)
+            if block is not None:
+                block.copy_to(output)
+            if stats_output is not None:
+                write_stats(stats, next_index + 1, stats_output)
+            next_index += 1
+
+#parser, parse cap and limits shared with forked worker processes
+WORKER = None
+WORKER_OPTIONS = (None, None, None)
+
+def parse_sentence(job):
+    index, line = job
+    WORKER.stats = None
+    block = BlockBuffer()
+    parse_limited(WORKER, line, block, *WORKER_OPTIONS)
+    return index, block.close(), WORKER.stats
+
+#parse sentences in worker processes, longest first, writing results in input order
+def parse_parallel(CKY, lines, workers, output, max_parses=None, timeout=None, max_tokens=None, stats_output=None):
+    global WORKER, WORKER_OPTIONS
+    #build the lazily computed yield bounds before forking so every worker shares them
+    if CKY.span_filter:
+        CKY.grammar.span_bounds()
+    WORKER = CKY
+    WORKER_OPTIONS = (max_parses, timeout, max_tokens)
+
+    order = sorted(range(len(lines)), key=lambda i: -len(lines[i].split(' ')))
+    pending = {}
+    next_index = 0
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        for index, block, stats in pool.imap_unordered(parse_sentence, [(i, lines[i]) for i in order]):
+            pending[index] = (block, stats)
+            while next_index in pending:
+                block, stats = pending.pop(next_index)
+                block.copy_to(output)
+                if stats_output is not None:
+                    write_stats(stats, next_index + 1, stats_output)
+                next_index += 1
 
 #MAIN FUNCTION
 def main():
-    grammar = open(sys.argv[1]).read().strip()
-    test = open(sys.argv[2]).read().strip()
-    output = open(sys.argv[3], 'w')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('grammar')
+    parser.add_argument('test', nargs='?')
+    parser.add_argument('output', nargs='?')
+    parser.add_argument('--max-parses', type=int, default=None,
+                        help='write at most this many parses per sentence (0 writes them all)')
+    parser.add_argument('--no-span-filter', action='store_true',
+                        help='keep chart entries that cannot be part of a complete parse')
+    parser.add_argument('--share-prefixes', action='store_true',
+                        help='parse sentences in token order, reusing chart columns for shared leading words')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes parsing sentences in parallel')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not read or write the compiled grammar cache')
+    parser.add_argument('--stream', action='store_true',
+                        help='read sentences from stdin and write each result to stdout as soon as it is ready')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds allowed per sentence before it is skipped')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='skip sentences with more tokens than this')
+    parser.add_argument('--stats', metavar='FILE', default=None,
+                        help='write per-sentence chart counters to FILE as JSON lines')
+    args = parser.parse_args()
+    if args.max_parses is not None and args.max_parses < 0:
+        parser.error('--max-parses must be 0 or more')
+    if args.max_parses == 0:
+        args.max_parses = None
+    stats_output = open(args.stats, 'w') if args.stats else None
 
     CKY = CKYParser()
-    CKY.initialize_grammar(grammar)
+    CKY.instrument = stats_output is not None
+    CKY.share_prefixes = args.share_prefixes
+    CKY.span_filter = not args.no_span_filter
+    if args.stream:
+        CKY.load_grammar(args.grammar, cache=not args.no_cache)
+        parse_stream(CKY, sys.stdin, sys.stdout, args.max_parses, args.timeout, args.max_tokens, stats_output,
+                     flush_parses=True)
+        if stats_output is not None:
+            stats_output.close()
+        return
+    if args.test is None or args.output is None:
+        parser.error('test and output files are required unless --stream is given')
+
+    test = open(args.test).read().strip()
+    output = open(args.output, 'w')
+    CKY.load_grammar(args.grammar, cache=not args.no_cache)
 
-    for line in test.split('\n'):
-        l = line.split(' ')
-        table = CKY.initialize_table(l)
-        parses = CKY.parse(table)
-        output.write(line+'\n')
-        for p in parses:
-            output.write(p+'\n')
-        output.write("Number of parses:"+str(len(parses)))
-        output.write("\n\n")
+    if args.workers > 1:
+        parse_parallel(CKY, test.split('\n'), args.workers, output, args.max_parses, args.timeout, args.max_tokens, stats_output)
+    elif args.share_prefixes:
+        parse_sorted(CKY, test.split('\n'), output, args.max_parses, args.timeout, args.max_tokens, stats_output)
+    else:
+        parse_stream(CKY, test.split('\n'), output, args.max_parses, args.timeout, args.max_tokens, stats_output)
 
 
     output.close()
+    if stats_output is not None:
+        stats_output.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,225 @@
+"""
+Kim Dodds - LING 571 - Winter 2020
+HW 4 Benchmark File
+
+Benchmarks the probabilistic CKY parser across sentence
+length and ambiguity. Synthetic sentences of each requested
+length are sampled from the PCFG itself and binned by their
+number of parses, and the test sentences are run as well.
+Wall time, peak memory and chart entries are written per
+sentence to a JSON file together with per-length averages,
+which can be compared against a stored earlier run.
+"""
+
+#PREPROCESSOR DIRECTIVES
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from hw4_parser import CKYParser
+
+class SentenceSampler:
+    """
+    Samples sentences of an exact length from a PCFG. inside[X][L] is the
+    total probability of X deriving exactly L words, so choosing each rule
+    and split point in proportion to it yields length-L sentences with
+    their PCFG probabilities.
+    """
+    def __init__(self, grammar, max_length):
+        self.grammar = grammar
+        size = len(grammar.nonterminals)
+        self.words = [[] for i in range(size)]
+        for word, parents in grammar.lexical.items():
+            for p, lp in parents:
+                self.words[p].append((word, 10 ** lp))
+        self.rules = [[] for i in range(size)]
+        for a, rights in grammar.binary.items():
+            for b, parents in rights.items():
+                for p, lp in parents:
+                    self.rules[p].append((a, b, 10 ** lp))
+
+        self.inside = [[0.0] * (max_length + 1) for i in range(size)]
+        for p in range(size):
+            self.inside[p][1] = sum(w for word, w in self.words[p])
+        for length in range(2, max_length + 1):
+            for p in range(size):
+                total = 0.0
+                for a, b, w in self.rules[p]:
+                    for k in range(1, length):
+                        total += w * self.inside[a][k] * self.inside[b][length - k]
+                self.inside[p][length] = total
+
+    def sample(self, length, rng):
+        if self.inside[self.grammar.top][length] == 0:
+            return None
+        words = []
+        self.expand(self.grammar.top, length, rng, words)
+        return words
+
+    def expand(self, label, length, rng, words):
+        if length == 1:
+            options = self.words[label]
+            words.append(rng.choices([w for w, p in options], [p for w, p in options])[0])
+            return
+        options = []
+        weights = []
+        for a, b, w in self.rules[label]:
+            for k in range(1, length):
+                weight = w * self.inside[a][k] * self.inside[b][length - k]
+                if weight > 0:
+                    options.append((a, b, k))
+                    weights.append(weight)
+        a, b, k = rng.choices(options, weights)[0]
+        self.expand(a, k, rng, words)
+        self.expand(b, length - k, rng, words)
+
+    def count_parses(self, words):
+        """
+        Number of start-symbol derivations of the words, ignoring probabilities.
+        """
+        n = len(words)
+        if n == 0 or any(w not in self.grammar.lexical for w in words):
+            return 0
+        counts = [[None] * n for w in words]
+        for i, w in enumerate(words):
+            counts[i][i] = {}
+            for p, lp in self.grammar.lexical[w]:
+                counts[i][i][p] = counts[i][i].get(p, 0) + 1
+        for width in range(2, n + 1):
+            for i in range(n - width + 1):
+                j = i + width - 1
+                cell = counts[i][j] = {}
+                for k in range(i, j):
+                    right = counts[k+1][j]
+                    for a, count_a in counts[i][k].items():
+                        rights = self.grammar.binary.get(a)
+                        if rights is None:
+                            continue
+                        for b, count_b in right.items():
+                            for p, lp in rights.get(b, ()):
+                                cell[p] = cell.get(p, 0) + count_a * count_b
+        return counts[0][n-1].get(self.grammar.top, 0)
+
+#parse one sentence twice: once timed, once under tracemalloc for peak memory
+def measure(CKY, words):
+    CKY.output = io.StringIO()
+    start = time.perf_counter()
+    CKY.initialize_table(list(words))
+    seconds = time.perf_counter() - start
+    entries = CKY.chart_entries()
+
+    tracemalloc.start()
+    CKY.output = io.StringIO()
+    CKY.initialize_table(list(words))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, entries
+
+#parse the first sentence of each length untimed, so the lazily built grammar
+#tables (span bounds, context bounds, per-length filters) are not charged to it
+def warm_up(CKY, sentences):
+    seen = set()
+    for source, words, parses in sentences:
+        if len(words) not in seen:
+            seen.add(len(words))
+            CKY.output = io.StringIO()
+            CKY.initialize_table(list(words))
+
+#average time, memory and entries per (source, length)
+def summarize(results):
+    groups = {}
+    for r in results:
+        groups.setdefault((r['source'], r['length']), []).append(r)
+    summary = {}
+    for (source, length), rows in sorted(groups.items()):
+        summary.setdefault(source, {})[str(length)] = {
+            'sentences': len(rows),
+            'seconds': sum(r['seconds'] for r in rows) / len(rows),
+            'peak_bytes': sum(r['peak_bytes'] for r in rows) / len(rows),
+            'entries': sum(r['entries'] for r in rows) / len(rows)}
+    return summary
+
+#print the per-length mean time of this run against a stored run
+def compare(summary, baseline, out):
+    out.write("source\tlength\tbase_sec\tsec\tratio\tbase_entries\tentries\n")
+    for source, lengths in summary.items():
+        for length, row in lengths.items():
+            base = baseline.get(source, {}).get(length)
+            if base is None:
+                continue
+            ratio = row['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+            out.write("{}\t{}\t{:.6f}\t{:.6f}\t{:.2f}\t{:.1f}\t{:.1f}\n".format(
+                source, length, base['seconds'], row['seconds'], ratio, base['entries'], row['entries']))
+
+#MAIN FUNCTION
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('grammar')
+    parser.add_argument('test')
+    parser.add_argument('output')
+    parser.add_argument('--engine', choices=['viterbi', 'exhaustive', 'numpy', 'astar'], default='viterbi',
+                        help='parser engine to benchmark')
+    parser.add_argument('--lengths', default='5,10,15,20,25,30',
+                        help='comma-separated synthetic sentence lengths')
+    parser.add_argument('--ambiguity', default='1,10,100',
+                        help='comma-separated lower bounds of the parse-count bins')
+    parser.add_argument('--per-bin', type=int, default=3,
+                        help='synthetic sentences per length and ambiguity bin')
+    parser.add_argument('--tries', type=int, default=200,
+                        help='samples drawn per length while filling the bins')
+    parser.add_argument('--seed', type=int, default=571)
+    parser.add_argument('--baseline', default=None,
+                        help='earlier benchmark JSON to compare the per-length averages against')
+    args = parser.parse_args()
+
+    CKY = CKYParser()
+    CKY.engine = args.engine
+    CKY.load_grammar(args.grammar)
+
+    lengths = [int(l) for l in args.lengths.split(',')]
+    bounds = [int(b) for b in args.ambiguity.split(',')]
+    sampler = SentenceSampler(CKY.grammar, max(lengths))
+    rng = random.Random(args.seed)
+
+    sentences = []
+    for length in lengths:
+        bins = {b: [] for b in bounds}
+        for t in range(args.tries):
+            if all(len(found) >= args.per_bin for found in bins.values()):
+                break
+            words = sampler.sample(length, rng)
+            if words is None:
+                break
+            parses = sampler.count_parses(words)
+            bound = max([b for b in bounds if b <= parses], default=None)
+            if bound is not None and len(bins[bound]) < args.per_bin:
+                bins[bound].append((words, parses))
+        for bound in bounds:
+            for words, parses in bins[bound]:
+                sentences.append(('synthetic', words, parses))
+    for line in open(args.test).read().strip().split('\n'):
+        words = list(filter(None, line.split(' ')))
+        sentences.append(('test', words, sampler.count_parses(words)))
+
+    warm_up(CKY, sentences)
+    results = []
+    for source, words, parses in sentences:
+        seconds, peak, entries = measure(CKY, words)
+        results.append({'source': source, 'length': len(words), 'parses': parses,
+                        'seconds': seconds, 'peak_bytes': peak, 'entries': entries,
+                        'sentence': ' '.join(words)})
+
+    report = {'grammar': args.grammar, 'engine': args.engine,
+              'results': results, 'summary': summarize(results)}
+    with open(args.output, 'w') as out:
+        json.dump(report, out, indent=1)
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))['summary']
+        compare(report['summary'], baseline, sys.stdout)
+
+if __name__ == '__main__':
+    main()
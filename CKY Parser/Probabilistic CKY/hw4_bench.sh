@@ -0,0 +1,2 @@
+#!/bin/sh
+python3 hw4_bench.py $@
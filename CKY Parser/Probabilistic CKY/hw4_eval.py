@@ -0,0 +1,196 @@
+"""
+Kim Dodds - LING 571 - Winter 2020
+HW 4 Evaluation File
+
+Labeled bracket scoring of parser output against gold
+trees. Follows the evalb settings used for parses_base.eval:
+the root and preterminal brackets are not scored, and
+sentences the parser left blank are skipped. Besides
+precision, recall and F1 it reports crossing brackets,
+complete matches and tagging accuracy, and scores from
+separate runs or processes can be merged.
+"""
+
+#PREPROCESSOR DIRECTIVES
+import argparse
+import multiprocessing
+from collections import Counter
+from hw4_treebank import tokens
+
+#collect the (label, start, end) brackets and the preterminal tags of a tree, excluding the root
+def constituents(tree):
+    result = Counter()
+    tags = []
+    #each open node is [label, first word index, has a child constituent]
+    stack = []
+    words = 0
+    toks = tokens(tree)
+    i = 0
+    while i < len(toks):
+        if toks[i] == "(":
+            if stack:
+                stack[-1][2] = True
+            stack.append([toks[i+1], words, False])
+            i += 2
+            continue
+        if toks[i] == ")":
+            label, start, phrasal = stack.pop()
+            if phrasal and stack:
+                result[(label, start, words)] += 1
+            elif not phrasal:
+                tags.append(label)
+        else:
+            words += 1
+        i += 1
+    return result, tags
+
+#number of test brackets whose span crosses the span of some gold bracket
+def crossing(gold, test):
+    spans = set((start, end) for label, start, end in gold)
+    count = 0
+    for (label, start, end), n in test.items():
+        for s, e in spans:
+            if s < start < e < end or start < s < end < e:
+                count += n
+                break
+    return count
+
+class SentenceScore:
+    """
+    Counts for one sentence, in the columns of an evalb report.
+    status is 0 for a scored sentence and 2 for one the parser skipped.
+    """
+    __slots__ = ('length', 'status', 'matched', 'gold', 'test', 'crossing', 'words', 'tags')
+
+    def __init__(self, gold_tree, test_tree, test=None):
+        """
+        test optionally gives the test tree's (brackets, tags) directly,
+        so a parser can score a tree without writing it out first.
+        """
+        gold, gold_tags = constituents(gold_tree)
+        self.length = len(gold_tags)
+        if test is None and not test_tree.strip():
+            self.status = 2
+            self.matched = self.gold = self.test = self.crossing = self.words = self.tags = 0
+            return
+        test, test_tags = test if test is not None else constituents(test_tree)
+        self.status = 0
+        self.matched = sum((gold & test).values())
+        self.gold = sum(gold.values())
+        self.test = sum(test.values())
+        self.crossing = crossing(gold, test)
+        self.words = len(gold_tags)
+        self.tags = sum(1 for g, t in zip(gold_tags, test_tags) if g == t)
+
+    def row(self, index):
+        recall = 100.0 * self.matched / self.gold if self.gold else 0.0
+        precision = 100.0 * self.matched / self.test if self.test else 0.0
+        accuracy = 100.0 * self.tags / self.words if self.words else 0.0
+        return "{:4d} {:4d} {:4d}  {:6.2f} {:6.2f} {:5d} {:6d} {:4d} {:6d} {:6d} {:5d} {:8.2f}".format(
+            index, self.length, self.status, recall, precision, self.matched, self.gold,
+            self.test, self.crossing, self.words, self.tags, accuracy)
+
+class BracketScore:
+    def __init__(self):
+        self.sentences = 0
+        self.skipped = 0
+        self.matched = 0
+        self.gold = 0
+        self.test = 0
+        self.crossing = 0
+        self.complete = 0
+        self.no_crossing = 0
+        self.two_crossing = 0
+        self.words = 0
+        self.tags = 0
+
+    def add(self, gold_tree, test_tree):
+        return self.add_sentence(SentenceScore(gold_tree, test_tree))
+
+    def add_sentence(self, sentence):
+        self.sentences += 1
+        if sentence.status:
+            self.skipped += 1
+            return sentence
+        self.matched += sentence.matched
+        self.gold += sentence.gold
+        self.test += sentence.test
+        self.crossing += sentence.crossing
+        self.complete += sentence.matched == sentence.gold == sentence.test
+        self.no_crossing += sentence.crossing == 0
+        self.two_crossing += sentence.crossing <= 2
+        self.words += sentence.words
+        self.tags += sentence.tags
+        return sentence
+
+    def merge(self, other):
+        for name in vars(other):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def recall(self):
+        return 100.0 * self.matched / self.gold if self.gold else 0.0
+
+    def precision(self):
+        return 100.0 * self.matched / self.test if self.test else 0.0
+
+    def fmeasure(self):
+        p = self.precision()
+        r = self.recall()
+        return 2 * p * r / (p + r) if p + r else 0.0
+
+    def summary(self):
+        valid = self.sentences - self.skipped
+        lines = ["Number of sentence        = {:6d}".format(self.sentences),
+                 "Number of Skip  sentence  = {:6d}".format(self.skipped),
+                 "Number of Valid sentence  = {:6d}".format(valid),
+                 "Bracketing Recall         = {:6.2f}".format(self.recall()),
+                 "Bracketing Precision      = {:6.2f}".format(self.precision()),
+                 "Bracketing FMeasure       = {:6.2f}".format(self.fmeasure()),
+                 "Complete match            = {:6.2f}".format(100.0 * self.complete / valid if valid else 0.0),
+                 "Average crossing          = {:6.2f}".format(self.crossing / valid if valid else 0.0),
+                 "No crossing               = {:6.2f}".format(100.0 * self.no_crossing / valid if valid else 0.0),
+                 "2 or less crossing        = {:6.2f}".format(100.0 * self.two_crossing / valid if valid else 0.0),
+                 "Tagging accuracy          = {:6.2f}".format(100.0 * self.tags / self.words if self.words else 0.0)]
+        return "\n".join(lines)
+
+#score a slice of (index, gold, test) lines in a worker process
+def score_chunk(chunk):
+    score = BracketScore()
+    rows = [(index, score.add(g, t)) for index, g, t in chunk]
+    return score, rows
+
+#MAIN FUNCTION
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gold')
+    parser.add_argument('test')
+    parser.add_argument('--sentences', action='store_true',
+                        help='print an evalb-style line for every sentence before the summary')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes scoring sentences in parallel')
+    args = parser.parse_args()
+
+    gold = open(args.gold).read().strip('\n').split('\n')
+    #keep leading and trailing blank lines: each one is a skipped sentence
+    test = open(args.test).read().split('\n')
+    lines = [(i, g, t) for i, (g, t) in enumerate(zip(gold, test), 1)]
+
+    if args.workers > 1:
+        size = max(1, len(lines) // (args.workers * 4))
+        chunks = [lines[i:i+size] for i in range(0, len(lines), size)]
+        with multiprocessing.Pool(args.workers) as pool:
+            parts = pool.map(score_chunk, chunks)
+    else:
+        parts = [score_chunk(lines)]
+
+    score = BracketScore()
+    for part, rows in parts:
+        score.merge(part)
+        if args.sentences:
+            for index, sentence in rows:
+                print(sentence.row(index))
+    print(score.summary())
+
+if __name__ == '__main__':
+    main()
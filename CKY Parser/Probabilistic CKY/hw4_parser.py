@@ -10,137 +10,1830 @@ a CYK parser for a fragment of the ATIS corpus.
 import sys
 import os
 import re
-import nltk
-import numpy as np
-import pandas as pd
-from collections import Counter
 import math
+import io
+import time
+import mmap
+import hashlib
+import tempfile
+import heapq
+import signal
+import json
+import argparse
+import multiprocessing
+import collections
+import dbm
+import numpy as np
+from hw4_eval import BracketScore, SentenceScore
+
+#the vectorized engine pairs a width's chart entries instead of scoring every rule
+#densely when that takes this many times fewer candidates
+SPARSE_COST = 4
+
+#index of the group each position belongs to when groups of the given sizes are laid end to end
+def expand(sizes):
+    return np.repeat(np.arange(len(sizes)), sizes)
+
+
+#header of a compiled grammar cache file, followed by the sha256 of the source grammar
+CACHE_MAGIC = b'PCKYGRM1'
+
+#coarse cluster of a label for coarse-to-fine parsing: the part before the first
+#split or binarization suffix, so NP_NNP and NP_PRIME project onto NP and _X_9 onto _X
+COARSE_LABEL = re.compile(r'_?[^_]*')
+
+#the astar engine's context estimates are computed for sentence lengths up to a multiple of this
+CONTEXT_BUCKET = 16
+
+#(min, max) yield length of every label and (min, max) words before and after it
+#in a derivation from top, given binary (parent, left, right) rules and lexical parents
+def yield_bounds(labels, top, rules, lexical):
+    inf = math.inf
+    size = len(labels)
+    low = [inf] * size
+    for p in lexical:
+        low[p] = 1
+    changed = True
+    while changed:
+        changed = False
+        for p, a, b in rules:
+            if low[a] + low[b] < low[p]:
+                low[p] = low[a] + low[b]
+                changed = True
+    #rules whose children can never derive words cannot be used
+    rules = [(p, a, b) for p, a, b in rules if low[a] < inf and low[b] < inf]
+    children = [set() for i in range(size)]
+    for p, a, b in rules:
+        children[p].update((a, b))
+    below = []
+    for label in range(size):
+        seen = set()
+        stack = list(children[label])
+        while stack:
+            x = stack.pop()
+            if x not in seen:
+                seen.add(x)
+                stack.extend(children[x])
+        below.append(seen)
+
+    #every binary rule adds words, so a label that can derive itself has no maximum
+    high = [1 if low[x] == 1 else 0 for x in range(size)]
+    for x in range(size):
+        if x in below[x] or any(y in below[y] for y in below[x]):
+            high[x] = inf
+    changed = True
+    while changed:
+        changed = False
+        for p, a, b in rules:
+            if high[a] + high[b] > high[p]:
+                high[p] = high[a] + high[b]
+                changed = True
+    yields = [(low[x], high[x] if low[x] < inf else 0) for x in range(size)]
+
+    sides = []
+    for side in (0, 1):
+        #a child gains its sibling's words on one side and keeps its parent's context
+        edges = []
+        for p, a, b in rules:
+            edges.append((p, a, low[b] if side else 0, high[b] if side else 0))
+            edges.append((p, b, 0 if side else low[a], 0 if side else high[a]))
+        least = [inf] * size
+        most = [-1] * size
+        if top is not None:
+            least[top] = most[top] = 0
+        changed = True
+        while changed:
+            changed = False
+            for p, x, lo, hi in edges:
+                if least[p] + lo < least[x]:
+                    least[x] = least[p] + lo
+                    changed = True
+        #context grows without limit through an unbounded sibling or a cycle that adds words
+        unbounded = set()
+        for p, x, lo, hi in edges:
+            if least[p] < inf and (hi == inf or (hi > 0 and (p == x or p in below[x]))):
+                unbounded.add(x)
+                unbounded.update(below[x])
+        for x in unbounded:
+            most[x] = inf
+        changed = True
+        while changed:
+            changed = False
+            for p, x, lo, hi in edges:
+                if least[p] < inf and most[x] < inf and most[p] + hi > most[x]:
+                    most[x] = most[p] + hi
+                    changed = True
+        sides.append([(least[x], most[x]) for x in range(size)])
+    return yields, sides[0], sides[1]
 
 class CKYIndex:
-    index = None
-    terminal = None
-    nonterminal = None
+    __slots__ = ('index', 'terminal', 'labels', 'trees', 'scores', 'groups')
 
     def __init__(self):
         self.index = []
         self.terminal = ''
-        self.nonterminal = []
+        #parallel lists: nonterminal id, bracketed tree and log probability of each entry
+        self.labels = []
+        self.trees = []
+        self.scores = []
+        #entry positions of each label, built when the cell is first probed rule by rule
+        self.groups = None
+
+class ViterbiIndex:
+    __slots__ = ('index', 'terminal', 'scores', 'backpointers')
+
+    def __init__(self):
+        self.index = []
+        self.terminal = ''
+        #best log probability and (split, left, right) backpointer per nonterminal id
+        self.scores = {}
+        self.backpointers = {}
+
+class KBestChart:
+    """
+    Lazy k-best extraction over a filled Viterbi chart (Huang and Chiang's
+    algorithm 3). For each (row, col, label) node, derivations holds the
+    derivations found so far, best first, as (score, edge, ranks, order):
+    edge is (split, left, right, logprob), ranks pick the left and right
+    children's derivations and order numbers the edge. candidates is a
+    heap of the node's next derivations. Incoming edges are recovered
+    from the chart once per cell, and a node's next derivation is only
+    computed when a parent asks for it.
+    """
+    def __init__(self, grammar, chart):
+        self.grammar = grammar
+        self.chart = chart
+        self.cells = {}
+        self.derivations = {}
+        self.candidates = {}
+        self.seen = {}
+
+    def edges(self, row, col):
+        #incoming edges per label with their best score, in the order the
+        #viterbi fill visits them so that ties resolve to its backpointer
+        if (row, col) in self.cells:
+            return self.cells[(row, col)]
+        edges = {}
+        binary = self.grammar.binary
+        for split in range(col - 1, row - 1, -1):
+            left = self.chart[row][split].scores
+            right = self.chart[split + 1][col].scores
+            rule_driven = self.grammar.rule_driven(left, right)
+            for a, score_a in left.items():
+                rights = binary.get(a)
+                if rights is None:
+                    continue
+                if rule_driven:
+                    pairs = [(b, right[b]) for b in rights if b in right]
+                else:
+                    pairs = right.items()
+                for b, score_b in pairs:
+                    for lhs, logprob in rights.get(b, ()):
+                        edges.setdefault(lhs, []).append(((split, a, b, logprob), logprob + score_a + score_b))
+        self.cells[(row, col)] = edges
+        return edges
+
+    def kth(self, node, k):
+        """
+        Make sure the k best derivations of node are computed, if it has
+        that many; returns the list of derivations found.
+        """
+        row, col, label = node
+        if node not in self.derivations:
+            if row == col:
+                self.derivations[node] = [(self.chart[row][col].scores[label], None, (), 0)]
+                self.candidates[node] = []
+                return self.derivations[node]
+            heap = []
+            for order, (edge, score) in enumerate(self.edges(row, col).get(label, ())):
+                heap.append((-score, order, edge, (0, 0)))
+            heapq.heapify(heap)
+            self.derivations[node] = []
+            self.candidates[node] = heap
+            self.seen[node] = set((order, (0, 0)) for order in range(len(heap)))
+        derivations = self.derivations[node]
+        heap = self.candidates[node]
+        while len(derivations) < k:
+            if derivations and derivations[-1][1] is not None:
+                self.successors(node, derivations[-1])
+            if not heap:
+                break
+            score, order, edge, ranks = heapq.heappop(heap)
+            if ranks == (0, 0):
+                #an edge's first candidate was scored from the chart; fill in its children
+                split, a, b, logprob = edge
+                self.kth((row, split, a), 1)
+                self.kth((split + 1, col, b), 1)
+            derivations.append((-score, edge, ranks, order))
+        return derivations
+
+    def successors(self, node, derivation):
+        #push the derivations one rank worse in either child
+        row, col, label = node
+        score, edge, ranks, order = derivation
+        split, a, b, logprob = edge
+        children = ((row, split, a), (split + 1, col, b))
+        for i in range(2):
+            next_ranks = (ranks[0] + 1, ranks[1]) if i == 0 else (ranks[0], ranks[1] + 1)
+            if (order, next_ranks) in self.seen[node]:
+                continue
+            if len(self.kth(children[i], next_ranks[i] + 1)) <= next_ranks[i]:
+                continue
+            self.seen[node].add((order, next_ranks))
+            left = self.derivations[children[0]][next_ranks[0]][0]
+            right = self.derivations[children[1]][next_ranks[1]][0]
+            heapq.heappush(self.candidates[node], (-(logprob + left + right), order, edge, next_ranks))
+
+    def tree(self, node, rank):
+        row, col, label = node
+        name = self.grammar.nonterminals[label]
+        derivation = self.derivations[node][rank]
+        if derivation[1] is None:
+            return "("+name+" "+self.chart[row][col].terminal+")"
+        split, a, b, logprob = derivation[1]
+        ranks = derivation[2]
+        return "("+name+" "+self.tree((row, split, a), ranks[0])+" "+self.tree((split + 1, col, b), ranks[1])+")"
+
+    def best(self, k):
+        """
+        Up to k (tree, log probability) pairs for the whole sentence, best first.
+        """
+        n = len(self.chart)
+        top = self.grammar.top
+        if n == 0 or top not in self.chart[0][n-1].scores:
+            return []
+        node = (0, n-1, top)
+        derivations = self.kth(node, k)
+        return [(self.tree(node, r), derivations[r][0]) for r in range(len(derivations))]
+
+class CKYGrammar:
+    """
+    Integer-compiled form of a PCFG in CNF. Nonterminals are mapped to
+    dense ids; binary rules are indexed left child -> right child ->
+    [(parent, logprob)] and lexical rules word -> [(parent, logprob)],
+    so the parser never builds or hashes rule strings.
+    """
+    __slots__ = ('nonterminals', 'ids', 'binary', 'lexical', 'top', 'tensors', 'priors', 'contexts', 'fanouts', 'bounds',
+                 'spans', 'coarse', 'projections')
+
+    def __init__(self):
+        self.nonterminals = []
+        self.ids = {}
+        self.binary = {}
+        self.lexical = {}
+        self.top = None
+        self.tensors = None
+        self.priors = None
+        self.contexts = None
+        self.fanouts = None
+        self.bounds = None
+        self.spans = {}
+        self.coarse = None
+        self.projections = {}
+
+    def intern(self, label):
+        if label not in self.ids:
+            self.ids[label] = len(self.nonterminals)
+            self.nonterminals.append(label)
+        return self.ids[label]
+
+    def add_rule(self, left, right, logprob):
+        parent = self.intern(left)
+        if len(right) == 1:
+            parents = self.lexical.setdefault(right[0], [])
+        else:
+            rights = self.binary.setdefault(self.intern(right[0]), {})
+            parents = rights.setdefault(self.intern(right[1]), [])
+        for i, (p, lp) in enumerate(parents):
+            if p == parent:
+                parents[i] = (parent, logprob)
+                return
+        parents.append((parent, logprob))
+        self.tensors = None
+        self.priors = None
+        self.contexts = None
+        self.fanouts = None
+        self.bounds = None
+        self.spans = {}
+        self.coarse = None
+        self.projections = {}
+
+    def rule_fanouts(self):
+        """
+        Number of distinct right children each nonterminal takes as the
+        left child of a binary rule.
+        """
+        if self.fanouts is None:
+            fanouts = [0] * len(self.nonterminals)
+            for a, rights in self.binary.items():
+                fanouts[a] = len(rights)
+            self.fanouts = fanouts
+        return self.fanouts
+
+    def rule_driven(self, left, right):
+        """
+        Whether to combine a left and a right cell, given their label
+        lists, rule by rule: probing the right cell for each right child
+        paired with a left label, instead of looking up every (left,
+        right) pair. Chosen when it needs under half the probes; right
+        cells of up to 4 labels always use pairs, since the saving there
+        cannot pay for the check.
+        """
+        return len(right) > 4 and 2 * sum(map(self.rule_fanouts().__getitem__, left)) < len(left) * len(right)
+
+    def coarse_grammar(self):
+        """
+        The grammar projected onto COARSE_LABEL clusters, as (coarse
+        grammar, coarse id of each fine label, fine labels of each coarse
+        label, binary rules, lexical rules); the last two are indexed like
+        binary and lexical but hold probabilities rather than log10
+        probabilities. A coarse rule's probability is the average of its
+        fine rules' probabilities over the fine parents, weighted by their
+        expected counts under the PCFG.
+        """
+        if self.coarse is None:
+            #equal for every fine label when the grammar is improper
+            weights = [10 ** w for w in self.unigram_priors()]
+            coarse = CKYGrammar()
+            project = [coarse.intern(COARSE_LABEL.match(label).group(0)) for label in self.nonterminals]
+            coarse.top = project[self.top]
+            members = [set() for label in coarse.nonterminals]
+            totals = [0.0] * len(coarse.nonterminals)
+            for label, c in enumerate(project):
+                members[c].add(label)
+                totals[c] += weights[label]
+            rules = {}
+            for a, rights in self.binary.items():
+                for b, parents in rights.items():
+                    for p, lp in parents:
+                        key = (project[p], (project[a], project[b]))
+                        rules[key] = rules.get(key, 0.0) + weights[p] * 10 ** lp
+            for word, parents in self.lexical.items():
+                for p, lp in parents:
+                    key = (project[p], (word,))
+                    rules[key] = rules.get(key, 0.0) + weights[p] * 10 ** lp
+            names = coarse.nonterminals
+            for (p, right), weight in rules.items():
+                if weight > 0:
+                    right = [names[right[0]], names[right[1]]] if len(right) == 2 else list(right)
+                    coarse.add_rule(names[p], right, math.log(weight / totals[p], 10))
+            binary = {a: {b: [(p, 10 ** lp) for p, lp in parents] for b, parents in rights.items()}
+                      for a, rights in coarse.binary.items()}
+            lexical = {word: [(p, 10 ** lp) for p, lp in parents] for word, parents in coarse.lexical.items()}
+            self.coarse = (coarse, project, [frozenset(m) for m in members], binary, lexical)
+        return self.coarse
+
+    def coarse_labels(self, labels):
+        """
+        The coarse labels of a set of fine labels, cached per set.
+        """
+        if labels not in self.projections:
+            project = self.coarse_grammar()[1]
+            self.projections[labels] = frozenset(project[x] for x in labels)
+        return self.projections[labels]
+
+    def rule_arrays(self):
+        """
+        Binary rules as parallel parent/left/right/logprob arrays sorted by
+        parent, plus the distinct parents and the offset of each parent's
+        block, for the vectorized engine. pairs holds the rules' (left, right)
+        children as left * |nonterminals| + right in sorted order, and
+        by_pair the rule index of each.
+        """
+        if self.tensors is None:
+            rules = sorted((p, a, b, lp) for a, rights in self.binary.items()
+                           for b, parents in rights.items() for p, lp in parents)
+            parent = np.array([r[0] for r in rules], dtype=np.intp)
+            left = np.array([r[1] for r in rules], dtype=np.intp)
+            right = np.array([r[2] for r in rules], dtype=np.intp)
+            logprob = np.array([r[3] for r in rules], dtype=np.float64)
+            parents, starts = np.unique(parent, return_index=True)
+            blocks = {}
+            for p, start, end in zip(parents, starts, np.append(starts[1:], len(rules))):
+                blocks[int(p)] = (start, end)
+            by_pair = np.argsort(left * len(self.nonterminals) + right, kind='stable')
+            pairs = (left * len(self.nonterminals) + right)[by_pair]
+            self.tensors = (left, right, logprob, parents, starts, blocks, parent, pairs, by_pair)
+        return self.tensors
+
+    def unigram_priors(self):
+        """
+        Log10 unigram probability of each nonterminal: its expected count
+        in a derivation from the start symbol, normalized over all
+        nonterminals. Used as a context-free outside estimate. The counts
+        are only finite when derivations are expected to end; for an
+        improper grammar, or when the counts come out negative or
+        non-finite, every nonterminal gets the same prior.
+        """
+        if self.priors is None:
+            size = len(self.nonterminals)
+            flow = np.zeros((size, size))
+            for a, rights in self.binary.items():
+                for b, parents in rights.items():
+                    for p, lp in parents:
+                        flow[p, a] += 10 ** lp
+                        flow[p, b] += 10 ** lp
+            start = np.zeros(size)
+            start[self.top] = 1.0
+            counts = None
+            #the expected counts converge only if the expected number of children per label is below 1 in the limit
+            if np.abs(np.linalg.eigvals(flow)).max(initial=0.0) < 1.0:
+                try:
+                    counts = np.linalg.solve(np.eye(size) - flow.T, start)
+                except np.linalg.LinAlgError:
+                    pass
+            if counts is None or not np.isfinite(counts).all() or counts.min() < -1e-9 or counts.sum() <= 0:
+                self.priors = [-math.log10(size)] * size
+            else:
+                with np.errstate(divide='ignore'):
+                    self.priors = np.log10(np.clip(counts, 0, None) / counts.sum()).tolist()
+        return self.priors
+
+    def context_bounds(self, n):
+        """
+        SX outside estimate (Klein and Manning 2003) of the binary rules
+        alone: an upper bound on the product of the rules outside a label
+        with l words before it and r words after it, indexed [label][l][r]
+        for l + r < n. Each sibling's rules are bounded by the best rule
+        product of its label over any k words, with every lexical rule
+        scored 0, so the bound holds whatever the words are and the words'
+        own scores can be bounded separately. Labels that cannot have l and
+        r words around them get -inf. The bounds do not depend on the
+        sentence length, so they are computed up to the next multiple of
+        CONTEXT_BUCKET words and kept for every shorter sentence.
+        """
+        if self.contexts is None or len(self.contexts[0]) < n:
+            size = max(-(-n // CONTEXT_BUCKET), 1) * CONTEXT_BUCKET
+            left, right, logprob, parents, starts, blocks, parent = self.rule_arrays()[:7]
+            #best rule product inside each label over any k words
+            inside = np.full((len(self.nonterminals), size + 1), -np.inf)
+            for entries in self.lexical.values():
+                for p, lp in entries:
+                    inside[p, 1] = 0.0
+            for k in range(2, size + 1):
+                np.maximum.at(inside[:, k], parent, (inside[left, 1:k] + inside[right, k-1:0:-1]).max(axis=1) + logprob)
+            outside = np.full((len(self.nonterminals), size, size), -np.inf)
+            if self.top is not None:
+                outside[self.top, 0, 0] = 0.0
+            for total in range(1, size):
+                for l in range(total + 1):
+                    r = total - l
+                    cell = outside[:, l, r]
+                    #as a left child its sibling takes 1 to r of the words after it, as a right child 1 to l before it
+                    if r:
+                        np.maximum.at(cell, left, (outside[parent, l, r-1::-1] + inside[right, 1:r+1]).max(axis=1) + logprob)
+                    if l:
+                        np.maximum.at(cell, right, (outside[parent, l-1::-1, r] + inside[left, 1:l+1]).max(axis=1) + logprob)
+            self.contexts = [[row[:size - l] for l, row in enumerate(label)] for label in outside.tolist()]
+        return self.contexts
+
+    def span_bounds(self):
+        """
+        Bounds on where each nonterminal can sit in a complete parse.
+        yields[X] is the (min, max) number of words X derives; left[X] and
+        right[X] are the (min, max) number of words a derivation from the
+        start symbol can put before and after X. Unbounded maxima are inf,
+        and labels the start symbol cannot reach have a minimum of inf.
+        """
+        if self.bounds is None:
+            self.bounds = yield_bounds(self.nonterminals, self.top,
+                                       [(p, a, b) for a, rights in self.binary.items()
+                                        for b, parents in rights.items() for p, lp in parents],
+                                       [p for parents in self.lexical.values() for p, lp in parents])
+        return self.bounds
+
+    def span_labels(self, n, after=True):
+        """
+        Labels that can fill a cell in a complete parse, as a table
+        indexed by the number of words before the cell and the number
+        after it, grown to cover sentences of n words. When after is
+        false only the words before the cell are checked.
+        """
+        yields, left, right = self.span_bounds()
+        table = self.spans.setdefault(after, [])
+        while len(table) < n:
+            table.append([])
+        for words, row in enumerate(table[:n]):
+            while len(row) < n - words:
+                rest = len(row) if after else None
+                row.append(frozenset(x for x in range(len(self.nonterminals))
+                                     if left[x][0] <= words <= left[x][1]
+                                     and (rest is None or right[x][0] <= rest <= right[x][1])))
+        return table
+
+    def span_mask(self, n):
+        """
+        span_labels(n) as a boolean array indexed by the number of words
+        before the cell, the number after it and the label, for the
+        vectorized engine.
+        """
+        yields, left, right = self.span_bounds()
+        words = np.arange(n)[:, None]
+        before = (np.array([b[0] for b in left]) <= words) & (words <= np.array([b[1] for b in left]))
+        after = (np.array([b[0] for b in right]) <= words) & (words <= np.array([b[1] for b in right]))
+        return before[:, None, :] & after[None, :, :]
+
+    def save(self, path, digest):
+        """
+        Write the compiled grammar as a flat binary file: magic, source
+        digest and counts, then the rule columns as raw arrays and the
+        nonterminal and word strings as newline-joined UTF-8 blocks.
+        Rules keep their insertion order so a loaded grammar iterates
+        exactly like one built from text.
+        """
+        binary = [(a, b, p, lp) for a, rights in self.binary.items()
+                  for b, parents in rights.items() for p, lp in parents]
+        words = list(self.lexical)
+        lexical = [(w, p, lp) for w, word in enumerate(words) for p, lp in self.lexical[word]]
+        names = "\n".join(self.nonterminals).encode('utf-8')
+        vocab = "\n".join(words).encode('utf-8')
+        top = -1 if self.top is None else self.top
+        header = [len(self.nonterminals), len(words), len(binary), len(lexical), top, len(names), len(vocab)]
+        columns = [np.array([r[3] for r in binary], dtype=np.float64),
+                   np.array([r[2] for r in lexical], dtype=np.float64),
+                   np.array([r[0] for r in binary], dtype=np.int32),
+                   np.array([r[1] for r in binary], dtype=np.int32),
+                   np.array([r[2] for r in binary], dtype=np.int32),
+                   np.array([r[0] for r in lexical], dtype=np.int32),
+                   np.array([r[1] for r in lexical], dtype=np.int32)]
+        #a uniquely named temporary file, so runs saving at the same time never write into one file
+        handle, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(digest)
+            f.write(np.array(header, dtype=np.int64).tobytes())
+            for column in columns:
+                f.write(column.tobytes())
+            f.write(names)
+            f.write(vocab)
+        #mkstemp creates the file readable by its owner only
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+
+    def load(self, path, digest):
+        """
+        Memory-map a cache file written by save. Returns False, leaving
+        the grammar untouched, if the file is missing, unreadable, shorter
+        or longer than its header says, or was compiled from a different
+        source grammar.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            if data[:len(CACHE_MAGIC)] != CACHE_MAGIC or data[len(CACHE_MAGIC):len(CACHE_MAGIC)+32] != digest:
+                return False
+            offset = len(CACHE_MAGIC) + 32
+            size, nwords, nbinary, nlexical, top, nnames, nvocab = np.frombuffer(data, np.int64, 7, offset).tolist()
+            offset += 7 * 8
+            columns = []
+            for dtype, count in [(np.float64, nbinary), (np.float64, nlexical), (np.int32, nbinary),
+                                 (np.int32, nbinary), (np.int32, nbinary), (np.int32, nlexical), (np.int32, nlexical)]:
+                columns.append(np.frombuffer(data, dtype, count, offset).tolist())
+                offset += count * np.dtype(dtype).itemsize
+            #a truncated or half-written file is rebuilt
+            if offset + nnames + nvocab != len(data):
+                return False
+            names = data[offset:offset+nnames].decode('utf-8')
+            vocab = data[offset+nnames:offset+nnames+nvocab].decode('utf-8')
+        except ValueError:
+            return False
+        finally:
+            data.close()
+
+        binary_lp, lexical_lp, left, right, parent, word, lexical_parent = columns
+        self.__init__()
+        self.nonterminals = names.split("\n") if size else []
+        self.ids = {label: i for i, label in enumerate(self.nonterminals)}
+        words = vocab.split("\n") if nwords else []
+        for a, b, p, lp in zip(left, right, parent, binary_lp):
+            self.binary.setdefault(a, {}).setdefault(b, []).append((p, lp))
+        for w, p, lp in zip(word, lexical_parent, lexical_lp):
+            self.lexical.setdefault(words[w], []).append((p, lp))
+        self.top = None if top < 0 else top
+        return True
+
+class ParseCache:
+    """
+    Parse results keyed by grammar hash, parser settings and token
+    sequence. The most recently used results are held in memory up to
+    size entries; with a path, every result is also stored in a dbm
+    file that is consulted on a memory miss and survives across runs.
+    """
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.disk = dbm.open(path, 'c') if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        if self.disk is not None and key in self.disk:
+            self.disk_hits += 1
+            result = self.disk[key].decode('utf-8')
+            self.remember(key, result)
+            return result
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self.remember(key, result)
+        if self.disk is not None:
+            self.disk[key] = result.encode('utf-8')
+
+    def remember(self, key, result):
+        if self.size <= 0:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def summary(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries)}
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
 
 class CKYParser:
-    left_right = None
-    right_left = None
+    grammar = None
 
     def __init__(self):
-        self.left_right = {}
-        self.right_left = {}
-        self.probabilities = Counter()
-        self.vocab = Counter()
+        self.grammar = CKYGrammar()
         self.output = None
-        self.top = None
+        self.engine = 'viterbi'
+        #per-cell pruning for the viterbi engine: keep at most beam entries
+        #and drop entries more than threshold below the cell's best
+        self.beam = None
+        self.threshold = None
+        self.fom = False
+        #drop chart entries whose label cannot have the words before and
+        #after their span in any complete parse; this never changes the parse
+        self.span_filter = True
+        #coarse-to-fine: only fine labels whose coarse label has at least this
+        #posterior in a cell under the coarse grammar are built there
+        self.coarse_threshold = None
+        #viterbi engine: write the kbest best parses per sentence instead of one
+        self.kbest = None
+        #exhaustive and viterbi engines: reuse the leading chart columns of the
+        #previous sentence when it starts with the same tokens
+        self.share_prefixes = False
+        self.prefix = None
+        #chart filled for the most recent sentence, if it reached an engine
+        self.chart = None
+        #when instrument is set, counters for the most recent sentence
+        self.instrument = False
+        self.stats = None
+        #sha256 of the grammar source, and an optional ParseCache of finished results
+        self.digest = b''
+        self.cache = None
+        self.engines = {'exhaustive': self.parse, 'viterbi': self.viterbi,
+                        'numpy': self.vectorized, 'astar': self.astar}
 
     def initialize_grammar(self, raw_grammar):
         grammar = raw_grammar.strip(" ").split('\n')
         if "%start" in grammar[0]:
-            self.top = grammar[0].split(" ")[1]
+            self.grammar.top = self.grammar.intern(grammar[0].split(" ")[1])
         for g in grammar:
             g = g.split(' -> ')
             if len(g) > 1:
-                left = g[0]
                 temp = g[1].split(" ")
                 if len(temp) == 2:
-                    right = temp[0].strip("'")
-                    self.vocab[right] = 1
-                    prob = float(temp[1].strip("[]"))
+                    right = [temp[0].strip("'")]
                 else:
-                    right = temp[0] + " " + temp[1]
-                    prob = float(temp[2].strip("[]"))
-                self.probabilities[(left + " -> " + right)] = math.log(prob, 10)
-                if left not in self.left_right:
-                   self.left_right[left] = []
-                if right not in self.left_right[left]:
-                    self.left_right[left].append(right)
-                if right not in self.right_left:
-                    self.right_left[right] = []
-                if left not in self.right_left[right]:
-                    self.right_left[right].append(left)
+                    right = temp[:2]
+                prob = float(temp[-1].strip("[]"))
+                self.grammar.add_rule(g[0], right, math.log(prob, 10))
 
+        self.digest = hashlib.sha256(raw_grammar.encode('utf-8')).digest()
         return
 
+    def load_grammar(self, path, cache=True):
+        """
+        Load a grammar file, using the compiled cache at path + '.cache'
+        when it was built from the same file contents and rebuilding it
+        otherwise.
+        """
+        raw = open(path, 'rb').read()
+        digest = hashlib.sha256(raw).digest()
+        if cache and self.grammar.load(path + '.cache', digest):
+            self.digest = digest
+            return
+        self.initialize_grammar(raw.decode('utf-8').strip())
+        self.digest = digest
+        if cache:
+            try:
+                self.grammar.save(path + '.cache', digest)
+            except OSError:
+                pass
+
+    def cache_key(self, tokens):
+        """
+        Parse cache key for a sentence: the grammar hash, every setting
+        that can change the chosen parse, and the tokens with empty
+        tokens removed.
+        """
+        settings = repr((self.engine, self.beam, self.threshold, self.fom, self.kbest, self.span_filter,
+                         self.coarse_threshold, self.share_prefixes))
+        text = settings + '\0' + ' '.join(filter(None, tokens))
+        return hashlib.sha256(self.digest + text.encode('utf-8')).hexdigest()
+
     def initialize_table(self, tokens):
+        self.chart = None
         tokens = list(filter(None, tokens))
-        table = np.empty( (len(tokens), len(tokens)), dtype=object )
+        if self.instrument:
+            self.stats = {'tokens': len(tokens), 'engine': self.engine, 'seconds': 0.0}
+        table = [[None] * len(tokens) for t in tokens]
         i = 0
         while i < len(tokens):
-            if self.vocab[tokens[i]] != 1:
+            if tokens[i] not in self.grammar.lexical:
                 self.output.write("\n")
                 return
-            table[i,i] = CKYIndex()
-            table[i,i].terminal = tokens[i]
-            table[i,i].index = [i,i+1]
+            table[i][i] = CKYIndex()
+            table[i][i].terminal = tokens[i]
+            table[i][i].index = [i,i+1]
             i += 1
+        if self.span_filter and self.grammar.top is not None:
+            low, high = self.grammar.span_bounds()[0][self.grammar.top]
+            if not low <= len(tokens) <= high:
+                self.output.write("\n")
+                return
+
+        if self.stats is None:
+            return self.engines[self.engine](table)
+        start = time.perf_counter()
+        result = self.engines[self.engine](table)
+        self.stats['seconds'] = time.perf_counter() - start
+        self.stats['chart_entries'] = self.chart_entries()
+        if 'cells' in self.stats:
+            self.count_combinations()
+        return result
+
+    def count_combinations(self):
+        """
+        Recount from the finished chart the entry pairs the binary fill
+        combined, the rule lookups it made (left-child probes plus
+        (left, right) pair probes, or right-cell probes per rule where it
+        went rule by rule) and how many found rules, so the fill loops
+        themselves carry no counters.
+        """
+        binary = self.grammar.binary
+        chart = self.chart
+        labels = [[None if cell is None else (cell.labels if isinstance(cell, CKYIndex) else list(cell.scores))
+                   for cell in row] for row in chart]
+        pairs = lookups = hits = rule_splits = 0
+        for col in range(len(chart)):
+            for row in range(col):
+                for split in range(row, col):
+                    left = labels[row][split]
+                    right = labels[split + 1][col]
+                    pairs += len(left) * len(right)
+                    lookups += len(left)
+                    if self.grammar.rule_driven(left, right):
+                        rule_splits += 1
+                        present = set(right)
+                        for a in left:
+                            rights = binary.get(a)
+                            if rights is None:
+                                continue
+                            lookups += len(rights)
+                            hits += 1
+                            for b in rights:
+                                if b in present:
+                                    hits += 1
+                        continue
+                    for a in left:
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        lookups += len(right)
+                        hits += 1
+                        for b in right:
+                            if b in rights:
+                                hits += 1
+        self.stats.update(pairs=pairs, lookups=lookups, hits=hits, rule_splits=rule_splits)
+
+    def reuse_prefix(self, table, chart):
+        """
+        Copy into chart the columns of the previous sentence's chart whose
+        cells span only tokens the two sentences share at the start, and
+        return the first column left to fill. Cells of a column depend only
+        on the tokens up to it, except that the pruned engines leave the
+        whole-sentence cell unpruned, so that column is never shared then.
+        Nothing is shared in coarse-to-fine mode, where every cell depends
+        on the whole sentence.
+        """
+        if not self.share_prefixes or self.coarse_threshold is not None:
+            return 0
+        n = len(table)
+        terminals = [table[i][i].terminal for i in range(n)]
+        settings = (self.engine, self.beam, self.threshold, self.fom, self.span_filter)
+        start = 0
+        if self.prefix is not None and self.prefix[3] == settings:
+            previous, filled = self.prefix[0], self.prefix[2]
+            limit = min(filled, n)
+            if self.engine == 'viterbi' and (self.beam or self.threshold is not None):
+                limit = min(limit, len(previous) - 1, n - 1)
+            while start < limit and previous[start] == terminals[start]:
+                start += 1
+            old = self.prefix[1]
+            for col in range(start):
+                for row in range(col + 1):
+                    chart[row][col] = old[row][col]
+        #terminals, chart, number of finished columns, and the settings that filled them
+        self.prefix = [terminals, chart, start, settings]
+        if self.stats is not None:
+            self.stats['reused_columns'] = start
+        return start
 
-        return self.parse(table)
+    def cell_filters(self, table):
+        """
+        Table of the labels allowed in the sentence's cell at
+        [row][n - 1 - col], or None when every label is: those that can
+        have the cell's words before and after them in a complete parse,
+        narrowed to the coarse pass's survivors in coarse-to-fine mode.
+        Columns shared across sentences by reuse_prefix must not depend
+        on the sentence length, so then only the words before a cell are
+        checked.
+        """
+        n = len(table)
+        spans = None
+        if self.span_filter and self.grammar.top is not None:
+            after = not self.share_prefixes or self.coarse_threshold is not None
+            spans = self.grammar.span_labels(n, after)
+        if self.coarse_threshold is None or self.grammar.top is None:
+            return spans
+        return self.coarse_filters(table, spans)
+
+    def coarse_filters(self, table, spans):
+        """
+        Parse the sentence with the coarse grammar and allow in each cell
+        only the fine labels of coarse labels whose posterior there is at
+        least coarse_threshold, and that spans allows. If the coarse
+        grammar cannot parse the sentence neither can the fine one, and
+        every cell is left empty.
+        """
+        if self.stats is not None:
+            clock = time.perf_counter()
+        members = self.grammar.coarse_grammar()[2]
+        n = len(table)
+        posteriors = self.coarse_posteriors(table, spans)
+        nothing = frozenset()
+        allowed = [[nothing] * (n - row) for row in range(n)]
+        kept = 0
+        for row in range(n if posteriors is not None else 0):
+            for col in range(row, n):
+                labels = [c for c, p in posteriors[row][col].items() if p >= self.coarse_threshold]
+                if not labels:
+                    continue
+                kept += len(labels)
+                fine = frozenset().union(*[members[c] for c in labels])
+                allowed[row][n - 1 - col] = fine if spans is None else fine & spans[row][n - 1 - col]
+        if self.stats is not None:
+            self.stats['coarse_seconds'] = time.perf_counter() - clock
+            self.stats['coarse_kept'] = kept
+        return allowed
+
+    def coarse_posteriors(self, table, spans=None):
+        """
+        Posterior probability of each coarse label in each cell, from an
+        inside and an outside pass with the coarse grammar, or None when
+        the coarse grammar has no parse of the sentence. With a spans
+        table from cell_filters, a cell only gets the coarse labels of
+        fine labels allowed there. So that long sentences do not
+        underflow, each inside cell is divided by its largest entry,
+        whose natural log is kept in scale, and each outside cell is
+        kept multiplied by that entry over the sentence probability; a
+        posterior is then just the product of the two.
+        """
+        coarse, project, members, binary, lexical = self.grammar.coarse_grammar()
+        n = len(table)
+        every = range(len(coarse.nonterminals))
+        inside = [[None] * n for t in table]
+        scale = [[0.0] * n for t in table]
+        for col in range(n):
+            for row in range(col, -1, -1):
+                cell = inside[row][col] = {}
+                allowed = every if spans is None else self.grammar.coarse_labels(spans[row][n - 1 - col])
+                if row == col:
+                    for c, p in lexical.get(table[row][col].terminal, ()):
+                        if c in allowed:
+                            cell[c] = p
+                splits = [split for split in range(row, col) if inside[row][split] and inside[split + 1][col]]
+                if splits:
+                    scale[row][col] = max(scale[row][split] + scale[split + 1][col] for split in splits)
+                for split in splits:
+                    right = inside[split + 1][col]
+                    factor = math.exp(scale[row][split] + scale[split + 1][col] - scale[row][col])
+                    for a, p_a in inside[row][split].items():
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        p_a *= factor
+                        for b, p_b in right.items():
+                            parents = rights.get(b)
+                            if parents is None:
+                                continue
+                            for lhs, p in parents:
+                                if lhs in cell:
+                                    cell[lhs] += p * p_a * p_b
+                                elif lhs in allowed:
+                                    cell[lhs] = p * p_a * p_b
+                top = max(cell.values(), default=0.0)
+                if top > 0.0:
+                    for c in cell:
+                        cell[c] /= top
+                    scale[row][col] += math.log(top)
+        root = inside[0][n-1].get(coarse.top, 0.0) if n > 0 else 0.0
+        if root == 0.0:
+            return None
+
+        outside = [[{} for t in table] for t in table]
+        outside[0][n-1][coarse.top] = 1.0 / root
+        for width in range(n, 1, -1):
+            for row in range(n - width + 1):
+                col = row + width - 1
+                above = outside[row][col]
+                if not above:
+                    continue
+                for split in range(row, col):
+                    right = inside[split + 1][col]
+                    if not right or not inside[row][split]:
+                        continue
+                    out_left = outside[row][split]
+                    out_right = outside[split + 1][col]
+                    #both children's outside scales differ from the parent's by the split's inside factor
+                    factor = math.exp(scale[row][split] + scale[split + 1][col] - scale[row][col])
+                    for a, p_a in inside[row][split].items():
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        p_a *= factor
+                        for b, p_b in right.items():
+                            parents = rights.get(b)
+                            if parents is None:
+                                continue
+                            for lhs, p in parents:
+                                o = above.get(lhs)
+                                if o:
+                                    o *= p
+                                    out_left[a] = out_left.get(a, 0.0) + o * p_b * factor
+                                    out_right[b] = out_right.get(b, 0.0) + o * p_a
+        return [[None] * row + [{c: p * outside[row][col].get(c, 0.0) for c, p in inside[row][col].items()}
+                                for col in range(row, n)] for row in range(n)]
+
+    def start_counters(self):
+        self.stats.update(cells=0, entries=0, max_cell=0, max_cell_span=None,
+                          lexical_seconds=0.0, binary_seconds=0.0)
+
+    def record_cell(self, size, row, col, clock, phase):
+        stats = self.stats
+        stats[phase] += time.perf_counter() - clock
+        stats['cells'] += 1
+        stats['entries'] += size
+        if size > stats['max_cell']:
+            stats['max_cell'] = size
+            stats['max_cell_span'] = [row, col+1]
 
     def parse(self, table):
-        row = 0
-        col = 0
-        while col < len(table[0,:]):
-            while row >= 0:
+        names = self.grammar.nonterminals
+        binary = self.grammar.binary
+        grammar = self.grammar
+        n = len(table)
+        self.chart = table
+        stats = self.stats
+        if stats is not None:
+            self.start_counters()
+        filters = self.cell_filters(table)
+        every = range(len(self.grammar.nonterminals))
+        start = self.reuse_prefix(table, table)
+        for col in range(start, n):
+            for row in range(col, -1, -1):
+                if stats is not None:
+                    clock = time.perf_counter()
+                #only labels that can fill this cell in a complete parse are added
+                allowed = filters[row][n - 1 - col] if filters is not None else every
                 if row == col:
-                    term = table[row,col].terminal
-                    for nt in self.right_left[term]:
-                        table[row,col].nonterminal.append((nt,"("+nt+" "+term+")", self.probabilities[nt+" -> "+term]))
+                    cell = table[row][col]
+                    term = cell.terminal
+                    for nt, logprob in self.grammar.lexical[term]:
+                        if nt not in allowed:
+                            continue
+                        cell.labels.append(nt)
+                        cell.trees.append("("+names[nt]+" "+term+")")
+                        cell.scores.append(logprob)
+                    if stats is not None:
+                        self.record_cell(len(cell.labels), row, col, clock, 'lexical_seconds')
+                    continue
+
+                cell = table[row][col] = CKYIndex()
+                cell.index = [row,col+1]
+                for split in range(col - 1, row - 1, -1):
+                    left = table[row][split]
+                    right = table[split + 1][col]
+                    if len(right.labels) > 4 and grammar.rule_driven(left.labels, right.labels):
+                        #probe the right cell per rule instead of per entry pair
+                        if right.groups is None:
+                            right.groups = {}
+                            for i, b in enumerate(right.labels):
+                                right.groups.setdefault(b, []).append(i)
+                        groups = right.groups
+                        for a, tree_a, score_a in zip(left.labels, left.trees, left.scores):
+                            rights = binary.get(a)
+                            if rights is None:
+                                continue
+                            for b, parents in rights.items():
+                                found = groups.get(b)
+                                if found is None:
+                                    continue
+                                for i in found:
+                                    tree_b = right.trees[i]
+                                    score_b = right.scores[i]
+                                    for lhs, logprob in parents:
+                                        if lhs not in allowed:
+                                            continue
+                                        cell.labels.append(lhs)
+                                        cell.trees.append("("+names[lhs]+" "+tree_a+" "+tree_b+")")
+                                        cell.scores.append(logprob + score_a + score_b)
+                        continue
+                    for a, tree_a, score_a in zip(left.labels, left.trees, left.scores):
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        for b, tree_b, score_b in zip(right.labels, right.trees, right.scores):
+                            parents = rights.get(b)
+                            if parents is None:
+                                continue
+                            for lhs, logprob in parents:
+                                if lhs not in allowed:
+                                    continue
+                                cell.labels.append(lhs)
+                                cell.trees.append("("+names[lhs]+" "+tree_a+" "+tree_b+")")
+                                cell.scores.append(logprob + score_a + score_b)
+                if stats is not None:
+                    self.record_cell(len(cell.labels), row, col, clock, 'binary_seconds')
+            if self.prefix is not None:
+                self.prefix[2] = col + 1
+
+        parses = []
+        if n > 0:
+            root = table[0][n-1]
+            for label, tree, score in zip(root.labels, root.trees, root.scores):
+                if label == self.grammar.top: parses.append((tree, score))
+        return self.output_parses(parses)
+
+    def viterbi(self, table):
+        """
+        Fill the chart keeping only the best score per nonterminal per
+        cell, then rebuild the single best tree from the backpointers.
+        """
+        binary = self.grammar.binary
+        fanouts = self.grammar.rule_fanouts()
+        n = len(table)
+        chart = self.chart = [[None] * n for t in table]
+        #rule fan-out summed over each cell's labels, computed the first time
+        #the cell is the left child of a split with a large right cell
+        fans = [[None] * n for t in table]
+        stats = self.stats
+        if stats is not None:
+            self.start_counters()
+        filters = self.cell_filters(table)
+        every = range(len(self.grammar.nonterminals))
+        start = self.reuse_prefix(table, chart)
+        for col in range(start, n):
+            for row in range(col, -1, -1):
+                if stats is not None:
+                    clock = time.perf_counter()
+                cell = chart[row][col] = ViterbiIndex()
+                cell.index = [row,col+1]
+                best = cell.scores
+                backpointers = cell.backpointers
+                #only labels that can fill this cell in a complete parse are added
+                allowed = filters[row][n - 1 - col] if filters is not None else every
+                if row == col:
+                    cell.terminal = table[row][col].terminal
+                    for nt, logprob in self.grammar.lexical[cell.terminal]:
+                        if nt in allowed:
+                            best[nt] = logprob
+                            backpointers[nt] = None
+                    if (self.beam or self.threshold is not None) and n > 1:
+                        self.prune(cell)
+                    if stats is not None:
+                        self.record_cell(len(cell.scores), row, col, clock, 'lexical_seconds')
+                    continue
+
+                for split in range(col - 1, row - 1, -1):
+                    left = chart[row][split].scores
+                    right = chart[split + 1][col].scores
+                    if len(right) > 4:
+                        fan = fans[row][split]
+                        if fan is None:
+                            fan = fans[row][split] = sum(map(fanouts.__getitem__, left))
+                    if len(right) > 4 and 2 * fan < len(left) * len(right):
+                        #the same test as CKYGrammar.rule_driven: probe the right cell per rule
+                        for a, score_a in left.items():
+                            rights = binary.get(a)
+                            if rights is None:
+                                continue
+                            for b, parents in rights.items():
+                                score_b = right.get(b)
+                                if score_b is None:
+                                    continue
+                                for lhs, logprob in parents:
+                                    score = logprob + score_a + score_b
+                                    if lhs in best:
+                                        if score > best[lhs]:
+                                            best[lhs] = score
+                                            backpointers[lhs] = (split, a, b)
+                                    elif lhs in allowed:
+                                        best[lhs] = score
+                                        backpointers[lhs] = (split, a, b)
+                        continue
+                    for a, score_a in left.items():
+                        rights = binary.get(a)
+                        if rights is None:
+                            continue
+                        for b, score_b in right.items():
+                            parents = rights.get(b)
+                            if parents is None:
+                                continue
+                            for lhs, logprob in parents:
+                                score = logprob + score_a + score_b
+                                if lhs in best:
+                                    if score > best[lhs]:
+                                        best[lhs] = score
+                                        backpointers[lhs] = (split, a, b)
+                                elif lhs in allowed:
+                                    best[lhs] = score
+                                    backpointers[lhs] = (split, a, b)
+
+                if (self.beam or self.threshold is not None) and (row, col) != (0, n-1):
+                    self.prune(cell)
+                if stats is not None:
+                    self.record_cell(len(cell.scores), row, col, clock, 'binary_seconds')
+            if self.prefix is not None:
+                self.prefix[2] = col + 1
+
+        if self.kbest:
+            return self.output_kbest(KBestChart(self.grammar, chart).best(self.kbest))
+        parses = []
+        if n > 0 and self.grammar.top in chart[0][n-1].scores:
+            top = self.grammar.top
+            parses.append((self.build_tree(chart, 0, n-1, top), chart[0][n-1].scores[top]))
+        return self.output_parses(parses)
+
+    def prune(self, cell):
+        """
+        Drop cell entries outside the beam. Entries are ranked by inside
+        score, or by inside score plus the unigram outside estimate when
+        the figure of merit is enabled.
+        """
+        scores = cell.scores
+        if len(scores) < 2:
+            return
+        if self.fom:
+            priors = self.grammar.unigram_priors()
+            merit = {label: score + priors[label] for label, score in scores.items()}
+        else:
+            merit = scores
+        keep = sorted(merit, key=merit.get, reverse=True)
+        if self.beam:
+            keep = keep[:self.beam]
+        if self.threshold is not None:
+            floor = merit[keep[0]] - self.threshold
+            keep = [label for label in keep if merit[label] >= floor]
+        if len(keep) < len(scores):
+            keep = set(keep)
+            cell.scores = {label: score for label, score in scores.items() if label in keep}
+            cell.backpointers = {label: bp for label, bp in cell.backpointers.items() if label in keep}
+
+    def sweep(self, sentences, gold, beams):
+        """
+        Parse the sentences once per beam setting, returning
+        (beam, seconds per sentence, parsed sentences, bracket F1) rows.
+        """
+        results = []
+        output = self.output
+        beam = self.beam
+        for b in beams:
+            self.beam = b
+            self.output = io.StringIO()
+            start = time.perf_counter()
+            for line in sentences:
+                self.initialize_table(line.split(' '))
+            elapsed = (time.perf_counter() - start) / len(sentences)
+            score = BracketScore()
+            for g, t in zip(gold, self.output.getvalue().split('\n')):
+                score.add(g, t)
+            results.append((b, elapsed, score.sentences - score.skipped, score.fmeasure()))
+        self.output = output
+        self.beam = beam
+        return results
+
+    def build_tree(self, chart, row, col, label):
+        cell = chart[row][col]
+        name = self.grammar.nonterminals[label]
+        if row == col:
+            return "("+name+" "+cell.terminal+")"
+        split, a, b = cell.backpointers[label]
+        return "("+name+" "+self.build_tree(chart, row, split, a)+" "+self.build_tree(chart, split + 1, col, b)+")"
+
+    def best_constituents(self):
+        """
+        (label, start, end) brackets and preterminal tags of the best parse
+        in the most recent viterbi chart, read off the backpointers in the
+        form hw4_eval.constituents gives for its tree, or None.
+        """
+        if self.engine != 'viterbi' or self.chart is None:
+            return None
+        n = len(self.chart)
+        if n == 0 or self.grammar.top not in self.chart[0][n-1].scores:
+            return None
+        names = self.grammar.nonterminals
+        result = collections.Counter()
+        tags = []
+        stack = [(0, n-1, self.grammar.top)]
+        while stack:
+            row, col, label = stack.pop()
+            if row == col:
+                tags.append(names[label])
+                continue
+            if (row, col) != (0, n-1):
+                result[(names[label], row, col + 1)] += 1
+            split, a, b = self.chart[row][col].backpointers[label]
+            stack.append((split + 1, col, b))
+            stack.append((row, split, a))
+        return result, tags
+
+    def vectorized(self, table):
+        """
+        Viterbi over a [n, n, |nonterminals|] array of log probabilities.
+        All spans of one width are filled at once: every (span, split, rule)
+        candidate is scored in a single array operation, maximized over
+        split points and then over each parent's block of rules. When the
+        left cells of a width hold few entries, as with sparse grammars,
+        each left entry is instead paired with the entries of its sibling
+        cell, read from a running list of the chart's finite entries, and
+        the pairs with the rules for their labels; the maxima are taken
+        with np.maximum.at. With the span filter, labels a cell
+        cannot hold are reset to -inf as each width is finished.
+        """
+        left, right, logprob, parents, starts, blocks, parent, pairs, by_pair = self.grammar.rule_arrays()
+        size = len(self.grammar.nonterminals)
+        n = len(table)
+        chart = self.chart = np.full((n, n, len(self.grammar.nonterminals)), -np.inf)
+        for i in range(n):
+            for nt, lp in self.grammar.lexical[table[i][i].terminal]:
+                chart[i, i, nt] = lp
+        mask = None
+        if self.span_filter and self.grammar.top is not None:
+            mask = self.grammar.span_mask(n)
+            diagonal = np.arange(n)
+            chart[diagonal, diagonal] = np.where(mask[diagonal, n - 1 - diagonal], chart[diagonal, diagonal], -np.inf)
+        #every finite chart entry so far as parallel row, width, label and score arrays,
+        #in order of cell = width * (n + 1) + row
+        found_r, found_a = np.isfinite(chart[np.arange(n), np.arange(n)]).nonzero()
+        found = [found_r, np.ones(len(found_r), dtype=np.intp), found_a, chart[found_r, found_r, found_a]]
+        cell_ids = (n + 1) + found_r
+        if len(left) > 0:
+            for width in range(2, n + 1):
+                rows = np.arange(n - width + 1)[:, None]
+                cols = rows + width - 1
+                #left children: entries whose row leaves room for a right sibling within this width
+                near = found[0] <= n - width
+                r, k, a, inside = [column[near] for column in found]
+                sibling = (width - k) * (n + 1) + r + k
+                first = np.searchsorted(cell_ids, sibling)
+                many = np.searchsorted(cell_ids, sibling, 'right') - first
+                if many.sum() * SPARSE_COST < len(rows) * (width - 1) * len(left):
+                    #one candidate per (left entry, right entry in its sibling cell, rule with those children)
+                    entry = expand(many)
+                    other = first[entry] + np.arange(len(entry)) - (np.cumsum(many) - many)[entry]
+                    key = a[entry] * size + found[2][other]
+                    first_rule = np.searchsorted(pairs, key)
+                    rules = np.searchsorted(pairs, key, 'right') - first_rule
+                    match = expand(rules)
+                    rule = by_pair[first_rule[match] + np.arange(len(match)) - (np.cumsum(rules) - rules)[match]]
+                    scores = (logprob[rule] + inside[entry[match]]) + found[3][other[match]]
+                    cells = np.full((len(rows), size), -np.inf)
+                    np.maximum.at(cells, (r[entry[match]], parent[rule]), scores)
+                    chart[rows[:, 0], cols[:, 0]] = cells
                 else:
-                    table[row,col] = CKYIndex()
-                    table[row,col].index = [row,col+1]
-                    ctemp = col - 1
-                    rtemp = col
-                    while rtemp != row:
-                        index1 = table[row, ctemp]
-                        index2 = table[rtemp, col]
-                        for i in index1.nonterminal:
-                            for j in index2.nonterminal:
-                                production = i[0] + " " + j[0]
-                                if production in self.right_left:
-                                    for lhs in self.right_left[production]:
-                                        rule = lhs + " -> " + production
-                                        table[row,col].nonterminal.append((lhs,"("+lhs+" "+i[1]+" "+j[1]+")", self.probabilities[rule] + i[2] + j[2]))
-                        ctemp -= 1
-                        rtemp -= 1
-
-                row -= 1
-            col += 1
-            row = col
+                    splits = rows + np.arange(width - 2, -1, -1)
+                    left_cells = chart[rows, splits]
+                    right_cells = chart[splits + 1, cols]
+                    #only score rules whose children occur in some cell of this width
+                    active = (np.isfinite(left_cells).any(axis=(0, 1))[left]
+                              & np.isfinite(right_cells).any(axis=(0, 1))[right]).nonzero()[0]
+                    best = np.full((len(rows), len(left)), -np.inf)
+                    if len(active) > 0:
+                        scores = (logprob[active] + left_cells[..., left[active]]) + right_cells[..., right[active]]
+                        best[:, active] = scores.max(axis=1)
+                    chart[rows, cols, parents] = np.maximum.reduceat(best, starts, axis=1)
+                cells = chart[rows[:, 0], cols[:, 0]]
+                if mask is not None:
+                    cells = np.where(mask[rows[:, 0], n - 1 - cols[:, 0]], cells, -np.inf)
+                    chart[rows[:, 0], cols[:, 0]] = cells
+                new_r, new_a = np.isfinite(cells).nonzero()
+                found = [np.concatenate((found[0], new_r)), np.concatenate((found[1], np.full(len(new_r), width))),
+                         np.concatenate((found[2], new_a)), np.concatenate((found[3], cells[new_r, new_a]))]
+                cell_ids = np.concatenate((cell_ids, width * (n + 1) + new_r))
 
         parses = []
-        for top in table[0,col-1].nonterminal:
-            if top[0] == self.top: parses.append(top[1])
+        if n > 0 and chart[0, n-1, self.grammar.top] > -np.inf:
+            top = self.grammar.top
+            parses.append((self.build_array_tree(table, chart, 0, n-1, top), float(chart[0, n-1, top])))
         return self.output_parses(parses)
 
+    def build_array_tree(self, table, chart, row, col, label):
+        name = self.grammar.nonterminals[label]
+        if row == col:
+            return "("+name+" "+table[row][col].terminal+")"
+        left, right, logprob, parents, starts, blocks = self.grammar.rule_arrays()[:6]
+        start, end = blocks[label]
+        splits = np.arange(col - 1, row - 1, -1)
+        scores = (logprob[start:end] + chart[row, splits][:, left[start:end]]) + chart[splits + 1, col][:, right[start:end]]
+        k, r = np.unravel_index(scores.argmax(), scores.shape)
+        split = int(splits[k])
+        return ("("+name+" "+self.build_array_tree(table, chart, row, split, left[start + r])+" "
+                +self.build_array_tree(table, chart, split + 1, col, right[start + r])+")")
+
+    def astar(self, table):
+        """
+        Agenda-driven best-first parsing. Items are popped in order of
+        inside score plus an admissible, monotonic outside estimate: the
+        label's context bound on the rules outside it for the number of
+        words before and after the span, plus the best lexical score of
+        every word outside the span. Each item is final when first popped,
+        and parsing stops once the start symbol over the whole sentence is
+        popped and no item left is within rounding of its priority. Ties
+        between equal-priority items go to the narrower span, and
+        equal-score derivations of one item keep the rightmost split, as
+        the viterbi engine does; between equal-score derivations over the
+        same split the two engines can keep different ones.
+        """
+        binary = self.grammar.binary
+        top = self.grammar.top
+        n = len(table)
+        if n == 0:
+            self.chart = []
+            return self.output_parses([])
+        contexts = self.grammar.context_bounds(n)
+        #best lexical score of each word, as prefix sums for the outside word estimate
+        prefix = [0.0]
+        for i in range(n):
+            prefix.append(prefix[-1] + max(lp for nt, lp in self.grammar.lexical[table[i][i].terminal]))
+
+        filters = self.cell_filters(table)
+        chart = self.chart = [[None] * n for t in table]
+        #finalized items indexed by start and end position: (other end, label, score)
+        starts = [[] for t in table]
+        ends = [[] for t in table]
+        discovered = {}
+        agenda = []
+        counter = 0
+
+        for i in range(n):
+            for nt, logprob in self.grammar.lexical[table[i][i].terminal]:
+                estimate = contexts[nt][i][n-1-i] + prefix[n] - (prefix[i+1] - prefix[i])
+                if estimate == -math.inf:
+                    continue
+                if filters is not None and nt not in filters[i][n - 1 - i]:
+                    continue
+                discovered[(nt, i, i)] = (logprob, None)
+                heapq.heappush(agenda, (-(logprob + estimate), 0, counter, nt, i, i))
+                counter += 1
+
+        found = False
+        while agenda:
+            priority, width, c, label, row, col = heapq.heappop(agenda)
+            if found and priority > last:
+                break
+            cell = chart[row][col]
+            if cell is None:
+                cell = chart[row][col] = ViterbiIndex()
+                cell.index = [row,col+1]
+                cell.terminal = table[row][col].terminal if row == col else ''
+            if label in cell.scores:
+                continue
+            score, backpointer = discovered[(label, row, col)]
+            cell.scores[label] = score
+            cell.backpointers[label] = backpointer
+            if label == top and row == 0 and col == n - 1:
+                found = True
+                #items whose priority differs only by rounding may still hold an equal-score split
+                last = priority + 1e-9
+                continue
+            starts[row].append((col, label, score))
+            ends[col].append((row, label, score))
+
+            combinations = []
+            rights = binary.get(label)
+            if rights is not None and col + 1 < n:
+                for end, b, score_b in starts[col + 1]:
+                    parents = rights.get(b)
+                    if parents is not None:
+                        for lhs, logprob in parents:
+                            combinations.append((lhs, row, end, logprob + score + score_b, (col, label, b)))
+            if row > 0:
+                for begin, a, score_a in ends[row - 1]:
+                    parents = binary.get(a, {}).get(label)
+                    if parents is not None:
+                        for lhs, logprob in parents:
+                            combinations.append((lhs, begin, col, logprob + score_a + score, (row - 1, a, label)))
+
+            for lhs, i, j, new_score, bp in combinations:
+                estimate = contexts[lhs][i][n-1-j] + prefix[n] - (prefix[j+1] - prefix[i])
+                if estimate == -math.inf:
+                    continue
+                if filters is not None and lhs not in filters[i][n - 1 - j]:
+                    continue
+                key = (lhs, i, j)
+                if key in discovered:
+                    old_score, old_bp = discovered[key]
+                    if old_score > new_score:
+                        continue
+                    if old_score == new_score:
+                        if bp[0] > old_bp[0]:
+                            discovered[key] = (new_score, bp)
+                            #rounding in the priorities can finalize an item before an equal-score split is found
+                            final = chart[i][j]
+                            if final is not None and lhs in final.backpointers:
+                                final.backpointers[lhs] = bp
+                        continue
+                discovered[key] = (new_score, bp)
+                heapq.heappush(agenda, (-(new_score + estimate), j - i, counter, lhs, i, j))
+                counter += 1
+
+        if self.stats is not None:
+            self.stats['agenda_pushes'] = counter
+        parses = []
+        if found:
+            parses.append((self.build_tree(chart, 0, n-1, top), chart[0][n-1].scores[top]))
+        return self.output_parses(parses)
+
+    def chart_entries(self):
+        """
+        Number of (span, nonterminal) entries in the most recent chart.
+        """
+        if self.chart is None:
+            return 0
+        if isinstance(self.chart, np.ndarray):
+            return int(np.isfinite(self.chart).sum())
+        return sum(len(cell.scores) for row in self.chart for cell in row if cell is not None)
+
     def output_parses(self, parses):
         if len(parses) < 1:
             self.output.write("\n")
         else:
-            parses = sorted(parses, key=lambda x:x[2], reverse=True)
-            self.output.write(parses[0]+'\n')
+            parses = sorted(parses, key=lambda x:x[1], reverse=True)
+            self.output.write(parses[0][0]+'\n')
+        return
+
+    def output_kbest(self, parses):
+        """
+        Write each (tree, log probability) pair as a tab-separated line,
+        then a blank line ending the sentence.
+        """
+        for tree, score in parses:
+            self.output.write("{}\t{}\n".format(score, tree))
+        self.output.write("\n")
+        return
+
+class ParseTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    raise ParseTimeout()
+
+#parse one sentence and return its output line; a sentence longer than
+#max_tokens or taking longer than timeout seconds gets a blank line
+def parse_limited(CKY, line, timeout=None, max_tokens=None):
+    CKY.chart = None
+    tokens = line.split(' ')
+    if max_tokens and len(list(filter(None, tokens))) > max_tokens:
+        return "\n"
+    key = None
+    if CKY.cache is not None:
+        key = CKY.cache_key(tokens)
+        result = CKY.cache.get(key)
+        if result is not None:
+            if CKY.instrument:
+                CKY.stats = {'tokens': len(list(filter(None, tokens))), 'cached': True}
+            return result
+    output = CKY.output
+    CKY.output = io.StringIO()
+    try:
+        if timeout:
+            signal.signal(signal.SIGALRM, raise_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        CKY.initialize_table(tokens)
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        result = CKY.output.getvalue()
+        if key is not None:
+            CKY.cache.put(key, result)
+    except ParseTimeout:
+        result = "\n"
+    finally:
+        #disarm the timer on every exit, so it cannot fire later in another sentence or the caller
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        CKY.output = output
+    return result
+
+#score a sentence's output against its gold tree, from the viterbi chart when there is one
+def score_sentence(CKY, gold, text):
+    if CKY.kbest:
+        text = text.split('\n')[0].split('\t')[-1]
+    test = CKY.best_constituents() if text.strip() else None
+    return SentenceScore(gold, text, test)
+
+#write one sentence's counters as a JSON line, with the mean cell size
+def write_stats(stats, index, stats_output):
+    if stats is None:
+        stats = {'tokens': 0, 'skipped': True}
+    stats = dict({'sentence': index}, **stats)
+    if 'cells' in stats:
+        stats['mean_cell'] = stats['entries'] / stats['cells'] if stats['cells'] else 0.0
+    stats_output.write(json.dumps(stats) + "\n")
+
+#parse sentences one at a time, writing and flushing each result as soon as it is ready;
+#with gold trees, each result is added to score as it is produced
+def parse_stream(CKY, lines, output, timeout=None, max_tokens=None, stats_output=None, gold=None, score=None):
+    for index, line in enumerate(lines, 1):
+        CKY.stats = None
+        text = parse_limited(CKY, line.rstrip('\n'), timeout, max_tokens)
+        output.write(text)
+        output.flush()
+        if stats_output is not None:
+            write_stats(CKY.stats, index, stats_output)
+            stats_output.flush()
+        if score is not None and index <= len(gold):
+            score.add_sentence(score_sentence(CKY, gold[index-1], text))
+
+#parse sentences in token order so that sentences sharing leading words are adjacent
+#and can reuse each other's chart columns, then write the results in input order
+def parse_sorted(CKY, lines, output, timeout=None, max_tokens=None, stats_output=None, gold=None, score=None):
+    order = sorted(range(len(lines)), key=lambda i: list(filter(None, lines[i].split(' '))))
+    results = [None] * len(lines)
+    for index in order:
+        CKY.stats = None
+        text = parse_limited(CKY, lines[index], timeout, max_tokens)
+        sentence = None
+        if score is not None and index < len(gold):
+            sentence = score_sentence(CKY, gold[index], text)
+        results[index] = (text, CKY.stats, sentence)
+    for index, (text, stats, sentence) in enumerate(results):
+        output.write(text)
+        if stats_output is not None:
+            write_stats(stats, index + 1, stats_output)
+        if sentence is not None:
+            score.add_sentence(sentence)
+
+#parser, limits and gold trees shared with forked worker processes
+WORKER = None
+WORKER_LIMITS = (None, None)
+WORKER_GOLD = None
+
+def parse_sentence(job):
+    index, line = job
+    WORKER.stats = None
+    text = parse_limited(WORKER, line, *WORKER_LIMITS)
+    sentence = None
+    if WORKER_GOLD is not None and index < len(WORKER_GOLD):
+        sentence = score_sentence(WORKER, WORKER_GOLD[index], text)
+    return index, text, WORKER.stats, sentence
+
+#parse sentences in worker processes, longest first, writing results in input order;
+#with a parse cache, hits and repeated sentences are answered without a worker
+def parse_parallel(CKY, lines, workers, output, timeout=None, max_tokens=None, stats_output=None,
+                   gold=None, score=None):
+    global WORKER, WORKER_LIMITS, WORKER_GOLD
+    #build lazily compiled tables before forking so every worker shares them
+    if CKY.engine == 'numpy':
+        CKY.grammar.rule_arrays()
+        CKY.grammar.span_bounds()
+    if CKY.engine == 'astar':
+        CKY.grammar.context_bounds(max((len(line.split()) for line in lines), default=0))
+    if CKY.fom:
+        CKY.grammar.unigram_priors()
+    if CKY.span_filter:
+        CKY.grammar.span_bounds()
+    if CKY.coarse_threshold is not None:
+        CKY.grammar.coarse_grammar()
+    cache = CKY.cache
+    CKY.cache = None
+    WORKER = CKY
+    WORKER_LIMITS = (timeout, max_tokens)
+    WORKER_GOLD = gold if score is not None else None
+    CKY.chart = None
+
+    results = {}
+    copies = {}
+    jobs = []
+    for i, line in enumerate(lines):
+        if cache is None:
+            jobs.append(i)
+            continue
+        key = CKY.cache_key(line.split(' '))
+        if key in copies:
+            copies[key].append(i)
+            cache.hits += 1
+            continue
+        result = cache.get(key)
+        if result is not None:
+            results[i] = (result, {'tokens': len(list(filter(None, line.split(' ')))), 'cached': True}
+                          if CKY.instrument else None, None)
+        else:
+            copies[key] = [i]
+            jobs.append(i)
+    order = sorted(jobs, key=lambda i: -len(lines[i].split(' ')))
+    next_index = 0
+
+    def flush(next_index):
+        while next_index in results:
+            text, stats, sentence = results.pop(next_index)
+            output.write(text)
+            if stats_output is not None:
+                write_stats(stats, next_index + 1, stats_output)
+            if score is not None and next_index < len(gold):
+                score.add_sentence(sentence or score_sentence(CKY, gold[next_index], text))
+            next_index += 1
+        return next_index
+
+    try:
+        next_index = flush(next_index)
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for index, text, stats, sentence in pool.imap_unordered(parse_sentence, [(i, lines[i]) for i in order]):
+                results[index] = (text, stats, sentence)
+                if cache is not None:
+                    key = CKY.cache_key(lines[index].split(' '))
+                    for copy in copies[key][1:]:
+                        results[copy] = (text, dict(stats, cached=True) if stats else stats, None)
+                    #a blank line may only mean the sentence ran out of time
+                    if timeout is None or text.strip():
+                        cache.put(key, text)
+                next_index = flush(next_index)
+    finally:
+        CKY.cache = cache
+
+#print the accuracy and speed of the run if it was scored, and close the parse cache,
+#printing its counters if asked
+def finish(cache, report, score=None, seconds=0.0):
+    if score is not None:
+        sys.stderr.write(score.summary() + "\n")
+        sys.stderr.write("Seconds                   = {:9.3f}\n".format(seconds))
+        sys.stderr.write("Sentences per second      = {:9.2f}\n".format(score.sentences / seconds if seconds else 0.0))
+    if cache is None:
         return
+    if report:
+        sys.stderr.write(json.dumps(cache.summary()) + "\n")
+    cache.close()
 
 #MAIN FUNCTION
 def main():
-    grammar = open(sys.argv[1]).read().strip()
-    test = open(sys.argv[2]).read().strip()
-    output = open(sys.argv[3], 'w')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('grammar')
+    parser.add_argument('test', nargs='?')
+    parser.add_argument('output', nargs='?')
+    parser.add_argument('--engine', choices=['viterbi', 'exhaustive', 'numpy', 'astar'], default='viterbi',
+                        help='chart engine used to find the best parse')
+    parser.add_argument('--beam', type=int, default=None,
+                        help='viterbi engine: keep at most this many entries per cell')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='viterbi engine: drop entries this many log10 units below the cell best')
+    parser.add_argument('--fom', action='store_true',
+                        help='viterbi engine: rank pruned entries by inside score plus unigram outside estimate')
+    parser.add_argument('--no-span-filter', action='store_true',
+                        help='keep chart entries that cannot be part of a complete parse')
+    parser.add_argument('--coarse-to-fine', type=float, default=None, metavar='THRESHOLD',
+                        help='parse with a coarse projection of the grammar first and build only the fine '
+                             'labels whose coarse label has at least this posterior in the cell')
+    parser.add_argument('--kbest', type=int, default=None, metavar='K',
+                        help='viterbi engine: write the K best parses with their log10 probabilities')
+    parser.add_argument('--eval', metavar='GOLD', default=None,
+                        help='score each parse against the gold trees in GOLD and print accuracy and speed to stderr')
+    parser.add_argument('--sweep', metavar='GOLD', default=None,
+                        help='viterbi engine: write a speed/accuracy report over --sweep-beams instead of parses')
+    parser.add_argument('--sweep-beams', default='1,2,5,10,20,0',
+                        help='comma-separated beam sizes for --sweep; 0 means no beam')
+    parser.add_argument('--share-prefixes', action='store_true',
+                        help='parse sentences in token order, reusing chart columns for shared leading words')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes parsing sentences in parallel')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not read or write the compiled grammar cache')
+    parser.add_argument('--stream', action='store_true',
+                        help='read sentences from stdin and write each parse to stdout as soon as it is ready')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds allowed per sentence before a blank line is written instead')
+    parser.add_argument('--max-tokens', type=int, default=None,
+                        help='write a blank line for sentences with more tokens than this')
+    parser.add_argument('--stats', metavar='FILE', default=None,
+                        help='write per-sentence chart counters to FILE as JSON lines')
+    parser.add_argument('--parse-cache', type=int, default=1024, metavar='N',
+                        help='keep the results of the N most recently parsed distinct sentences; 0 disables')
+    parser.add_argument('--parse-cache-file', metavar='FILE', default=None,
+                        help='also store parse results in FILE and reuse them on later runs')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print parse cache hits, misses and evictions to stderr when done')
+    args = parser.parse_args()
+    if args.kbest and (args.engine != 'viterbi' or args.sweep):
+        parser.error('--kbest needs the viterbi engine and cannot be combined with --sweep')
+    if args.engine != 'viterbi' and (args.beam or args.threshold is not None or args.fom or args.sweep):
+        parser.error('--beam, --threshold, --fom and --sweep need the viterbi engine')
+    if args.engine == 'numpy' and args.coarse_to_fine is not None:
+        parser.error('--coarse-to-fine does not apply to the numpy engine')
+    stats_output = open(args.stats, 'w') if args.stats else None
+    cache = None
+    if args.parse_cache > 0 or args.parse_cache_file:
+        cache = ParseCache(args.parse_cache, args.parse_cache_file)
+    gold = score = None
+    if args.eval:
+        gold = open(args.eval).read().strip('\n').split('\n')
+        score = BracketScore()
+    start = time.perf_counter()
+
+    if args.stream:
+        CKY = CKYParser()
+        CKY.engine = args.engine
+        CKY.beam = args.beam
+        CKY.threshold = args.threshold
+        CKY.fom = args.fom
+        CKY.kbest = args.kbest
+        CKY.span_filter = not args.no_span_filter
+        CKY.coarse_threshold = args.coarse_to_fine
+        CKY.share_prefixes = args.share_prefixes
+        CKY.instrument = stats_output is not None
+        CKY.cache = cache
+        CKY.load_grammar(args.grammar, cache=not args.no_cache)
+        parse_stream(CKY, sys.stdin, sys.stdout, args.timeout, args.max_tokens, stats_output, gold, score)
+        finish(cache, args.cache_stats, score, time.perf_counter() - start)
+        if stats_output is not None:
+            stats_output.close()
+        return
+    if args.test is None or args.output is None:
+        parser.error('test and output files are required unless --stream is given')
+
+    test = open(args.test).read().strip()
+    output = open(args.output, 'w')
 
     CKY = CKYParser()
     CKY.output = output
-    CKY.initialize_grammar(grammar)
+    CKY.engine = args.engine
+    CKY.beam = args.beam
+    CKY.threshold = args.threshold
+    CKY.fom = args.fom
+    CKY.kbest = args.kbest
+    CKY.span_filter = not args.no_span_filter
+    CKY.coarse_threshold = args.coarse_to_fine
+    CKY.share_prefixes = args.share_prefixes
+    CKY.instrument = stats_output is not None
+    CKY.cache = cache
+    CKY.load_grammar(args.grammar, cache=not args.no_cache)
 
-    for line in test.split('\n'):
-        l = line.split(' ')
-        CKY.initialize_table(l)
+    if args.sweep:
+        gold = open(args.sweep).read().strip('\n').split('\n')
+        beams = [int(b) or None for b in args.sweep_beams.split(',')]
+        output.write("beam\tthreshold\tfom\tsec/sent\tparsed\tF1\n")
+        for beam, elapsed, parsed, f1 in CKY.sweep(test.split('\n'), gold, beams):
+            output.write("{}\t{}\t{}\t{:.6f}\t{}\t{:.2f}\n".format(beam or '-', args.threshold
+                         if args.threshold is not None else '-', 'on' if args.fom else 'off', elapsed, parsed, f1))
+        output.close()
+        if stats_output is not None:
+            stats_output.close()
+        return
 
+    if args.workers > 1:
+        parse_parallel(CKY, test.split('\n'), args.workers, output, args.timeout, args.max_tokens, stats_output,
+                       gold, score)
+        output.close()
+        if stats_output is not None:
+            stats_output.close()
+        finish(cache, args.cache_stats, score, time.perf_counter() - start)
+        return
 
+    if args.share_prefixes:
+        parse_sorted(CKY, test.split('\n'), output, args.timeout, args.max_tokens, stats_output, gold, score)
+    else:
+        parse_stream(CKY, test.split('\n'), output, args.timeout, args.max_tokens, stats_output, gold, score)
     output.close()
+    if stats_output is not None:
+        stats_output.close()
+    finish(cache, args.cache_stats, score, time.perf_counter() - start)
 
 if __name__ == '__main__':
     main()
@@ -11,57 +11,129 @@ outputs a probabilistic grammar.
 #PREPROCESSOR DIRECTIVES
 import sys
 import os
-import re
-from nltk.tree import Tree
+import argparse
+import multiprocessing
 from collections import Counter
-import numpy as np
-import pandas as pd
+from hw4_treebank import productions
 
 class PCFG:
+    """
+    Rule counts are kept sparsely, one Counter entry per (lhs, rhs) seen
+    in the treebank, in the order the rules first appear.
+    """
     def __init__(self):
         self.rule_count = Counter()
         self.top = ''
 
-    def get_rules(self, treebank):
-        lhs = rhs = rules = []
-        self.top = re.findall("^\((\w+)",treebank)[0]
-        for t in treebank.split('\n'):
-            for pro in Tree.fromstring(t).productions():
-                rules.append(str(pro))
+    def add_tree(self, tree):
+        rules = productions(tree)
+        if not self.top and rules:
+            self.top = rules[0][0]
+        self.rule_count.update(rules)
 
-        temp = "#".join(rules)
-        lhs = set(re.findall("([^#\->]+) ->", temp))
-        rhs = set(re.findall("-> ([^#\->]+)", temp))
-
-        self.rule_count = pd.DataFrame(0, index=rhs, columns=lhs)
-        for r in rules:
-            r = r.split(" -> ")
-            self.rule_count.at[r[1],r[0]] += 1
+    def read_treebank(self, path, workers=1):
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                for shard in pool.map(count_shard, shards(path, workers * 4)):
+                    self.merge(shard)
+            return
+        with open(path) as treebank:
+            for t in treebank:
+                if t.strip():
+                    self.add_tree(t)
+        return
 
-        self.calc_probabilities()
+    def merge(self, other):
+        if not self.top:
+            self.top = other.top
+        self.rule_count.update(other.rule_count)
+        return self
 
+    def read_counts(self, path):
+        """
+        Add the raw rule counts of a file written by write_counts, so a
+        grammar can be extended with new trees without recounting the old.
+        """
+        with open(path) as counts:
+            for line in counts:
+                line = line.rstrip('\n')
+                if line.startswith('%start '):
+                    if not self.top:
+                        self.top = line[len('%start '):]
+                elif line:
+                    count, rule = line.split('\t', 1)
+                    lhs, rhs = rule.split(' -> ', 1)
+                    self.rule_count[(lhs, rhs)] += int(count)
         return
 
+    #one "count<TAB>lhs -> rhs" line per rule after the %start line
+    def write_counts(self, out):
+        out.write("%start {}\n".format(self.top))
+        for (lhs, rhs), count in self.rule_count.items():
+            out.write("{}\t{} -> {}\n".format(count, lhs, rhs))
+
     def calc_probabilities(self):
-        counts = self.rule_count.sum(axis=0)
-        for col in counts.keys():
-            self.rule_count[col] = self.rule_count[col].map(lambda val: val/counts[col])
-        return
+        counts = Counter()
+        for (lhs, rhs), count in self.rule_count.items():
+            counts[lhs] += count
+        rules = {}
+        for (lhs, rhs), count in self.rule_count.items():
+            rules.setdefault(lhs, []).append((rhs, count / counts[lhs]))
+        return rules
 
-    def output_grammar(self):
-        print("%start {}".format(self.top))
-        for lhs in self.rule_count.columns:
-            for rhs in self.rule_count.index:
-                if self.rule_count.at[rhs,lhs] != 0:
-                    print("{} -> {} [{}]".format(lhs,rhs,self.rule_count.at[rhs,lhs]))
+    def output_grammar(self, out=sys.stdout):
+        out.write("%start {}\n".format(self.top))
+        for lhs, rights in self.calc_probabilities().items():
+            for rhs, prob in rights:
+                out.write("{} -> {} [{}]\n".format(lhs, rhs, prob))
+
+#split the treebank into about n byte ranges of whole lines
+def shards(path, n):
+    size = os.path.getsize(path)
+    step = max(1, -(-size // n))
+    return [(path, start, min(start + step, size)) for start in range(0, size, step)]
+
+#count the trees whose lines start inside one byte range of the treebank
+def count_shard(shard):
+    path, start, end = shard
+    pcfg = PCFG()
+    with open(path, 'rb') as treebank:
+        if start:
+            #skip the rest of a line that began in the previous range
+            treebank.seek(start - 1)
+            treebank.readline()
+        while treebank.tell() < end:
+            t = treebank.readline().decode()
+            if not t:
+                break
+            if t.strip():
+                pcfg.add_tree(t)
+    return pcfg
 
 
 #MAIN FUNCTION
 def main():
-    treebank = open(sys.argv[1]).read().strip()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('treebank', nargs='*',
+                        help='treebank files whose rules are counted')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes counting shards of the treebank in parallel')
+    parser.add_argument('--add', action='append', default=[], metavar='COUNTS',
+                        help='rule count file to start from (repeatable); the treebanks are counted on top of it')
+    parser.add_argument('--counts', default=None,
+                        help='also write the total raw rule counts to this file')
+    args = parser.parse_args()
+    if not args.treebank and not args.add:
+        parser.error('give at least one treebank or --add count file')
 
     pcfg = PCFG()
-    pcfg.get_rules(treebank)
+    for path in args.add:
+        pcfg.read_counts(path)
+    for path in args.treebank:
+        pcfg.read_treebank(path, args.workers)
+    if args.counts:
+        with open(args.counts, 'w') as out:
+            pcfg.write_counts(out)
     pcfg.output_grammar()
 
 
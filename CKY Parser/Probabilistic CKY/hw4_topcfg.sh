@@ -1,2 +1,5 @@
 #!/bin/sh
-python3 hw4_topcfg.py $1 > $2
+treebank=$1
+output=$2
+shift 2
+python3 hw4_topcfg.py $treebank --counts $output.counts $@ > $output
@@ -0,0 +1,57 @@
+"""
+Kim Dodds - LING 571 - Winter 2020
+HW 4 Treebank Reader File
+
+Reads trees in the flat bracket notation of parses.train
+without building tree objects. tokens splits a tree into
+brackets, labels and words, and productions reads the
+grammar rules of a tree straight off the token stream.
+Used by hw4_topcfg.py for training and by hw4_eval.py
+for scoring.
+"""
+
+#PREPROCESSOR DIRECTIVES
+import re
+
+TOKEN = re.compile(r"\(|\)|[^\s()]+")
+
+#split a bracketed tree into "(", ")" and label or word tokens
+def tokens(tree):
+    return TOKEN.findall(tree)
+
+def productions(tree):
+    """
+    The (lhs, rhs) rules of a tree in the order nltk's Tree.productions()
+    gives them (a node before its children), with rhs written the way
+    nltk prints it: child labels bare and words quoted, e.g.
+    ('NP', 'DT NN') or ('DT', "'this'").
+    """
+    result = []
+    #each open node is [label, its slot in result, its children]
+    stack = []
+    toks = tokens(tree)
+    i = 0
+    while i < len(toks):
+        t = toks[i]
+        if t == "(":
+            label = ''
+            if i + 1 < len(toks) and toks[i+1] != "(" and toks[i+1] != ")":
+                label = toks[i+1]
+                i += 1
+            if stack:
+                stack[-1][2].append(label)
+            stack.append([label, len(result), []])
+            result.append(None)
+        elif t == ")":
+            if not stack:
+                raise ValueError("unbalanced ')' in tree: {}".format(tree.strip()))
+            label, slot, children = stack.pop()
+            result[slot] = (label, " ".join(children))
+        elif stack:
+            stack[-1][2].append(repr(t))
+        else:
+            raise ValueError("word outside brackets in tree: {}".format(tree.strip()))
+        i += 1
+    if stack:
+        raise ValueError("unbalanced '(' in tree: {}".format(tree.strip()))
+    return result
@@ -2,11 +2,11 @@
 Kim Dodds - LING 570 - Fall 2019
 HW 6 Implementation File
 
-The purpose of this project is to build a 
-language model using the output of the 
+The purpose of this project is to build a
+language model using the output of the
 program ngram_count. This program outputs
 the count, probability, log probability,
-and ngram for each ngram provided by the 
+and ngram for each ngram provided by the
 input file.
 """
 
@@ -15,92 +15,164 @@ import sys
 import os
 import math
 import re
+from array import array
+import numpy as np
+
+class NgramStore:
+  """
+  Unigrams, bigrams and trigrams with integer keys. Every word has an
+  id in vocab, and an n-gram's key packs the ids of its words side by
+  side into one 64-bit integer, bits wide each, the last word lowest.
+  When an order's ids do not fit in 64 bits, its keys are instead rows
+  of two 64-bit columns, the first word's id and the packed rest.
+  For each order, keys is sorted and counts, probs and logprobs are
+  parallel to it, so an n-gram is found by binary search. order holds
+  the positions of the n-grams in the order they were read.
+  """
+  def __init__(self):
+    self.vocab = {}
+    self.words = []
+    self.bits = 1
+    self.keys = []
+    self.counts = []
+    self.probs = []
+    self.logprobs = []
+    self.order = []
+
+  def read_counts(self, path):
+    #word ids and counts of every n-gram, per order, in file order
+    ids = [array('q') for k in range(3)]
+    counts = [array('q') for k in range(3)]
+    with open(path) as f:
+      for line in f:
+        line = line.strip('\n')
+        if not line:
+          continue
+        count, gram = line.split(" \t ", 1)
+        gram = gram.split(" ")
+        if len(gram) > 3:
+          continue
+        ids[len(gram) - 1].extend([self.vocab.setdefault(w, len(self.vocab)) for w in gram])
+        counts[len(gram) - 1].append(int(count))
+    self.words = list(self.vocab)
+    self.bits = max(1, (len(self.words) - 1).bit_length())
+    if self.bits * 2 > 64:
+      raise ValueError("{} words do not fit two to a 64-bit key".format(len(self.words)))
+
+    for k in range(3):
+      keys = self.pack(np.frombuffer(ids[k], dtype=np.int64).reshape(-1, k + 1))
+      if keys.ndim == 1:
+        order = np.argsort(keys, kind='stable')
+      else:
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+      self.keys.append(keys[order])
+      self.counts.append(np.frombuffer(counts[k], dtype=np.int64)[order])
+      #position in the sorted arrays of each n-gram in file order
+      self.order.append(np.argsort(order))
+    for k in range(3):
+      prob, logprob = self.estimate(k)
+      self.probs.append(prob)
+      self.logprobs.append(logprob)
+
+  #pack rows of word ids into keys, or into (first word, packed rest) rows when they do not fit 64 bits
+  def pack(self, ids):
+    if ids.shape[1] * self.bits > 64:
+      return np.column_stack((ids[:, 0].astype(np.uint64), self.pack(ids[:, 1:])))
+    keys = np.zeros(len(ids), dtype=np.uint64)
+    for j in range(ids.shape[1]):
+      keys = (keys << np.uint64(self.bits)) | ids[:, j].astype(np.uint64)
+    return keys
+
+  #rows of word ids of packed keys of order k
+  def unpack(self, keys, k):
+    if keys.ndim == 2:
+      return np.column_stack((keys[:, 0].astype(np.int64), self.unpack(keys[:, 1], k - 1)))
+    mask = np.uint64((1 << self.bits) - 1)
+    shifts = np.arange(k, -1, -1, dtype=np.uint64) * np.uint64(self.bits)
+    return ((keys[:, None] >> shifts) & mask).astype(np.int64)
+
+  #index of an n-gram in its order's arrays, or -1
+  def find(self, gram):
+    ids = [self.vocab.get(w) for w in gram]
+    if None in ids:
+      return -1
+    k = len(ids) - 1
+    key = self.pack(np.array([ids], dtype=np.int64))[0]
+    keys = self.keys[k]
+    if keys.ndim == 2:
+      #the rows of the first word, then the rest within them
+      start = int(np.searchsorted(keys[:, 0], key[0]))
+      end = int(np.searchsorted(keys[:, 0], key[0], side='right'))
+      i = start + int(np.searchsorted(keys[start:end, 1], key[1]))
+      return i if i < end and keys[i, 1] == key[1] else -1
+    i = int(np.searchsorted(keys, key))
+    return i if i < len(keys) and keys[i] == key else -1
+
+  def count(self, gram):
+    i = self.find(gram)
+    return int(self.counts[len(gram) - 1][i]) if i >= 0 else 0
+
+  def logprob(self, gram):
+    i = self.find(gram)
+    return float(self.logprobs[len(gram) - 1][i]) if i >= 0 else None
+
+  def estimate(self, k):
+    """
+    Truncated probabilities and log probabilities of the n-grams of
+    order k: unigrams over all unigram tokens, higher orders over the
+    count of their first k words.
+    """
+    counts = self.counts[k]
+    if k == 0:
+      history = float(counts.sum())
+    else:
+      #the key of the first k words is the key shifted right by one word
+      keys = self.keys[k]
+      if keys.ndim == 2:
+        prefix = (keys[:, 0] << np.uint64((k - 1) * self.bits)) | (keys[:, 1] >> np.uint64(self.bits))
+      else:
+        prefix = keys >> np.uint64(self.bits)
+      found = np.searchsorted(self.keys[k-1], prefix)
+      found = np.minimum(found, len(self.keys[k-1]) - 1)
+      if not (self.keys[k-1][found] == prefix).all():
+        raise KeyError("{}-gram without a count for its first words".format(k + 1))
+      history = self.counts[k-1][found].astype(float)
+    prob = truncate(counts / history)
+    #math.log, not np.log, so the digits match the scalar log exactly; only distinct values are logged
+    values, inverse = np.unique(prob, return_inverse=True)
+    logs = np.array([math.log(p, 10) for p in values.tolist()])
+    return prob, truncate(logs[inverse])
+
+  def output(self, out=sys.stdout, rows=65536):
+    """
+    Print the counts, probabilities and log probabilities of every
+    n-gram in the order they were read, converting rows n-grams of an
+    order at a time so whole orders are never turned into lists.
+    """
+    #print total counts for each ngram
+    out.write("\\data\\\n")
+    for k in range(3):
+      out.write("ngram {0}: type={1} token={2}\n".format(k + 1, len(self.keys[k]), int(self.counts[k].sum())))
+    #print data for each ngram, in the order they were read
+    for k in range(3):
+      out.write("\n\\{}-grams:\n".format(k + 1))
+      for start in range(0, len(self.order[k]), rows):
+        chunk = self.order[k][start:start + rows]
+        ids = self.unpack(self.keys[k][chunk], k).tolist()
+        for count, p, lp, gram in zip(self.counts[k][chunk].tolist(), self.probs[k][chunk].tolist(),
+                                      self.logprobs[k][chunk].tolist(), ids):
+          out.write("{} \t {} \t {} \t {}\n".format(count, p, lp, " ".join([self.words[i] for i in gram])))
 
 #MAIN FUNCTION
 def main():
-  #read in file
-  f = open(sys.argv[1])
-  f = f.read()
-  all_data = f.split('\n')
-
-  #initialize varaibles
-  uni_types = 0
-  uni_tokens = 0
-  uni_freq = {}
-  uni_sorted = []
-
-  bi_types = 0
-  bi_tokens = 0
-  bi_freq = {}
-  bi_sorted = []
-
-  tri_types = 0
-  tri_tokens = 0
-  tri_freq = {}
-  tri_sorted = []
-
-  #loop through each line of ngram data
-  for line in all_data:
-    #prepare data
-    line = line.strip('\n')
-    line = re.sub('\t', ' ', line)
-    temp = line.split(" ")
-    temp.remove('')
-
-    #check if unigram, bigram, or trigram
-    if len(temp) == 3:
-      #append data list with just count and tokens
-      uni_freq[temp[2]] = temp[0]
-      uni_sorted.append(temp[2])
-      #increment type
-      uni_types += 1
-      #add count to total tokens
-      uni_tokens += int(temp[0])
-    if len(temp) == 4:
-      two_word = (temp[2], temp[3])
-      bi_freq[two_word] = temp[0]
-      bi_types += 1
-      bi_tokens += int(temp[0])
-      bi_sorted.append(two_word)
-    if len(temp) == 5:
-      three_word = (temp[2], temp[3], temp[4])
-      tri_freq[three_word] = temp[0]
-      tri_types += 1
-      tri_tokens += int(temp[0])
-      tri_sorted.append(three_word)
-
-  #print total counts for each ngram
-  print("\\data\\")
-  print("ngram 1: type={0} token={1}".format(uni_types, uni_tokens))
-  print("ngram 2: type={0} token={1}".format(bi_types, bi_tokens))
-  print("ngram 3: type={0} token={1}\n".format(tri_types, tri_tokens))
-
-  #print data for each ngram
-  print(r"\1-grams:")
-  for u in uni_sorted:
-    #calculte probability and log probability and truncate to 10
-    prob = truncate(float(uni_freq[u])/float(uni_tokens))
-    logprob = truncate(math.log(prob, 10))
-    #print
-    print(uni_freq[u], "\t", prob, "\t", logprob, "\t", u)
-
-  print("\n\\2-grams:")
-  for b in bi_sorted:
-    prob = truncate(float(bi_freq[b])/float(uni_freq[b[0]]))
-    logprob = truncate(math.log(prob, 10))
-    print(bi_freq[b], "\t", prob, "\t", logprob, "\t", b[0] + " " + b[1])
-
-  print("\n\\3-grams:")
-  for t in tri_freq:
-    search_bi = (t[0], t[1])
-    prob = truncate(float(tri_freq[t])/float(bi_freq[search_bi]))
-    logprob = truncate(math.log(prob, 10))
-    print(tri_freq[t], "\t", prob, "\t", logprob, "\t", t[0] + " " + t[1] + " " + t[2])
-  
+  store = NgramStore()
+  store.read_counts(sys.argv[1])
+  store.output()
+
 #function to truncate to 10 decimal places
 def truncate(p):
   multiplier = 10 ** 10
-  return int(p * multiplier)/multiplier
+  return np.trunc(p * multiplier)/multiplier
 
 
 if __name__ == '__main__':
@@ -7,73 +7,229 @@ bigrams, and trigrams from a tokenized input file.
 This program output first unigrams then bigrams
 and lastly trigrams, each set sorted by frequency
 and grams with matching frequencies sorted alphbetically.
+Higher orders can be counted with --order N.
 """
 
 #PREPROCESSOR DIRECTIVES
 import sys
 import os
+import io
 import re
+import heapq
+import argparse
+import tempfile
+import multiprocessing
+from array import array
 from collections import Counter
 
+#turn a line into a list of token ids, adding new tokens to the vocabulary
+def encode(line, vocab):
+  #stip input of newline character
+  line = line.strip('\n')
+  #add "beginning of sentence" and "end of sentence" characters around the space-split tokens
+  sentence = ["<bos>"] + line.split(" ") + ["<eos>"]
+  return [vocab.setdefault(token, len(vocab)) for token in sentence]
+
+#count every n-gram of the sentence, counts[k] holding the (k+1)-grams
+def count_sentence(ids, counts):
+  for k in range(len(counts)):
+    #zipping k+1 shifted copies of the sentence slides a window of k+1 ids over it
+    counts[k].update(zip(*[ids[i:] for i in range(k + 1)]))
+
+#count the n-grams of order 1 to n in a file, keyed by tuples of token ids
+def count_file(path, n):
+  vocab = {}
+  counts = [Counter() for k in range(n)]
+  with open(path) as f:
+    for line in f:
+      count_sentence(encode(line.lower(), vocab), counts)
+  return counts, list(vocab)
+
+#split the file into about n byte ranges of whole lines
+def shards(path, n):
+  size = os.path.getsize(path)
+  step = max(1, -(-size // n))
+  return [(path, start, min(start + step, size)) for start in range(0, size, step)]
+
+def count_shard(job):
+  """
+  Count the lines that start inside one byte range of the file. The
+  result is packed for the trip back to the parent: the shard's words
+  joined by newlines, and per order the flat gram ids and the counts
+  as bytes of 64-bit integer arrays. With a limit, the counts are
+  instead spilled to sorted runs in directory whenever limit distinct
+  n-grams are held, and the list of run files is returned.
+  """
+  path, start, end, n, limit, directory = job
+  vocab = {}
+  counts = [Counter() for k in range(n)]
+  runs = []
+  with open(path, 'rb') as f:
+    if start:
+      #skip the rest of a line that began in the previous range
+      f.seek(start - 1)
+      f.readline()
+    while f.tell() < end:
+      line = f.readline()
+      if not line:
+        break
+      #split on lone \r as well, as count_file's text-mode reading does
+      for sentence in io.StringIO(line.decode(), newline=None):
+        count_sentence(encode(sentence.lower(), vocab), counts)
+        if limit and sum(map(len, counts)) >= limit:
+          runs.append(spill(counts, list(vocab), directory))
+          #the runs hold the words themselves, so ids can start over
+          vocab.clear()
+  if limit:
+    if any(counts):
+      runs.append(spill(counts, list(vocab), directory))
+    return runs
+  packed = []
+  for grams in counts:
+    ids = array('q')
+    for gram in grams:
+      ids.extend(gram)
+    packed.append((ids.tobytes(), array('q', grams.values()).tobytes()))
+  return "\n".join(vocab).encode(), packed
+
+#add packed shard counts into one set of counters over a shared vocabulary
+def merge_shards(parts, n):
+  vocab = {}
+  counts = [Counter() for k in range(n)]
+  for words, packed in parts:
+    remap = [vocab.setdefault(word, len(vocab)) for word in words.decode().split("\n")]
+    for k, (ids, freq) in enumerate(packed):
+      flat = array('q')
+      flat.frombytes(ids)
+      number = array('q')
+      number.frombytes(freq)
+      grams = iter([remap[i] for i in flat])
+      merged = counts[k]
+      for gram, count in zip(zip(*[grams] * (k + 1)), number):
+        merged[gram] += count
+  return counts, list(vocab)
+
+#write the counts to a run file sorted by order and then gram, and empty the counters
+def spill(counts, words, directory):
+  with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.run', delete=False, newline='\n') as run:
+    for k, grams in enumerate(counts):
+      total = sorted((" ".join([words[i] for i in gram]), count) for gram, count in grams.items())
+      for gram, count in total:
+        run.write("{}\t{}\t{}\n".format(k, count, gram))
+      grams.clear()
+  return run.name
+
+#write (order, gram, count) entries, already sorted, to a run file
+def write_run(entries, directory):
+  with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.run', delete=False, newline='\n') as run:
+    for k, gram, count in entries:
+      run.write("{}\t{}\t{}\n".format(k, count, gram))
+  return run.name
+
+#run files are written and read with newline='\n', so a gram holding a carriage return stays on its line
+def read_run(path):
+  with open(path, newline='\n') as run:
+    for line in run:
+      k, count, gram = line.rstrip('\n').split('\t', 2)
+      yield int(k), gram, int(count)
+
+#most run files read at once by a merge; more runs are first merged in groups of this size
+FAN_IN = 64
+
+def reduce_runs(runs, merge, directory):
+  while len(runs) > FAN_IN:
+    groups = [runs[i:i+FAN_IN] for i in range(0, len(runs), FAN_IN)]
+    runs = []
+    for group in groups:
+      runs.append(write_run(merge(group), directory))
+      for run in group:
+        os.remove(run)
+  return runs
+
+#k-way merge of runs sorted by order and gram, adding up the counts of each gram
+def merge_runs(runs):
+  current = None
+  total = 0
+  for k, gram, count in heapq.merge(*[read_run(run) for run in runs]):
+    if (k, gram) == current:
+      total += count
+      continue
+    if current is not None:
+      yield current + (total,)
+    current = (k, gram)
+    total = count
+  if current is not None:
+    yield current + (total,)
+
+#order, then frequency, then alphabetical
+def rank(entry):
+  return entry[0], -entry[2], entry[1]
+
+def merge_ranked(runs):
+  return heapq.merge(*[read_run(run) for run in runs], key=rank)
+
+def output_runs(runs, limit, directory, out=sys.stdout):
+  """
+  Print the total counts of the spilled runs in the same order as
+  output_counts. The merged totals are sorted by frequency limit
+  entries at a time into a second set of runs, which are merged again.
+  """
+  ranked = []
+  chunk = []
+  for entry in merge_runs(reduce_runs(runs, merge_runs, directory)):
+    chunk.append(entry)
+    if len(chunk) >= limit:
+      chunk.sort(key=rank)
+      ranked.append(write_run(chunk, directory))
+      chunk = []
+  chunk.sort(key=rank)
+  ranked = reduce_runs(ranked, merge_ranked, directory)
+  for k, gram, count in heapq.merge(*[read_run(run) for run in ranked], chunk, key=rank):
+    out.write("{} \t {}\n".format(count, gram))
+
+#print each order sorted by frequency and then alphabetically
+def output_counts(counts, words, out=sys.stdout):
+  for grams in counts:
+    total = [(" ".join([words[i] for i in gram]), count) for gram, count in grams.items()]
+    total.sort(key=lambda element: (-element[1], element[0]))
+    for gram, count in total:
+      out.write("{} \t {}\n".format(count, gram))
+
 #MAIN FUNCTION
 def main():
-  #open file and read in line
-  f = open(sys.argv[1])
-  line = f.readline().lower()
-
-  #initialize counters
-  unigrams = Counter()
-  bigrams = Counter()
-  trigrams = Counter()
-
-  #loop through each line in the file
-  while line:
-    #stip input of newline character
-    line = line.strip('\n')
-    #insert "beginning of sentence" character
-    sentence = ["<bos>"]
-    #split tokens by spaces 
-    sentence += line.split(" ")
-    #add "end of sentence" character
-    sentence += ["<eos>"]
-
-    #loop through each token in the line
-    for token in sentence:
-      #add each token to unigram counter
-      unigrams[token] += 1 
-      index = sentence.index(token)
-      #add two tokens to bigram counter
-      if index + 1 < len(sentence):
-        bi = token + " " + sentence[index + 1]
-        bigrams[bi] += 1
-      #add three tokens to trigram counter
-      if index + 2 < len(sentence):
-        tri = bi + " " + sentence[index + 2]
-        trigrams[tri] += 1
-    
-    #read in next line
-    line = f.readline().lower()
-
-  #get tuple list with all items and frequencies
-  uni_total = unigrams.items()
-  #sort by frequency and then alphabetically
-  uni_total = sorted(uni_total, key=lambda element: (-element[1], element[0]))
-  bi_total = bigrams.items()
-  bi_total = sorted(bi_total, key=lambda element: (-element[1], element[0]))
-  tri_total = trigrams.items()
-  tri_total = sorted(tri_total, key=lambda element: (-element[1], element[0]))
-
-  #print each item
-  for uni in uni_total:
-    print(uni[1], '\t', uni[0])
-
-  for bi in bi_total:
-    print(bi[1], '\t', bi[0])
-
-  for tri in tri_total:
-    print(tri[1], '\t', tri[0])
+  parser = argparse.ArgumentParser()
+  parser.add_argument('training_data')
+  parser.add_argument('--order', type=int, default=3,
+                      help='highest n-gram order to count')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of processes counting byte ranges of the input in parallel')
+  parser.add_argument('--max-entries', type=int, default=0,
+                      help='spill counts to sorted runs on disk whenever this many distinct n-grams are held (0 keeps all counts in memory)')
+  parser.add_argument('--tmp', default=None,
+                      help='directory for the spilled runs (default: the system temporary directory)')
+  args = parser.parse_args()
+  if args.order < 1:
+    parser.error('--order must be at least 1')
 
+  if args.max_entries:
+    with tempfile.TemporaryDirectory(dir=args.tmp) as directory:
+      jobs = [shard + (args.order, args.max_entries, directory)
+              for shard in shards(args.training_data, max(1, args.workers) * 4)]
+      if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+          runs = sum(pool.map(count_shard, jobs), [])
+      else:
+        runs = sum(map(count_shard, jobs), [])
+      output_runs(runs, args.max_entries, directory)
+    return
 
+  if args.workers > 1:
+    jobs = [shard + (args.order, 0, None) for shard in shards(args.training_data, args.workers * 4)]
+    with multiprocessing.Pool(args.workers) as pool:
+      counts, words = merge_shards(pool.imap(count_shard, jobs), args.order)
+  else:
+    counts, words = count_file(args.training_data, args.order)
+  output_counts(counts, words)
 
 
 if __name__ == '__main__':
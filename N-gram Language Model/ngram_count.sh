@@ -1,2 +1,5 @@
 #!/bin/sh
-python3 ngram_count.py $1 > $2
+input=$1
+output=$2
+shift 2
+python3 ngram_count.py $input $@ > $output